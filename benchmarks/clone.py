@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Compare the cost of cloning a template for a render against the
+``copy.deepcopy`` of its element and transforms that it replaced.
+
+    PYTHONPATH=. python benchmarks/clone.py
+"""
+
+import copy
+import timeit
+
+import wiseguy.html
+import wiseguy.template
+
+
+def make_template(rows):
+    table_rows = "".join(
+        "<tr><td class='n'>%s</td><td><a href='/item/%s'>Item</a></td></tr>" % (i, i)
+        for i in range(rows))
+
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html(
+            "<html><head><title></title></head>"
+            "<body><div id='main'></div><table>%s</table></body></html>" % table_rows)
+        transforms = [
+            wiseguy.template.Transform(
+                "key_%s" % i,
+                wiseguy.template.set_text("title", lambda **kwargs: "Title"),
+                dict(unused=dict(a=1, b=[1, 2, 3])))
+            for i in range(40)]
+
+    return template
+
+def deepcopy_clone(template):
+    return wiseguy.template.TemplateMeta(
+        'Template',
+        (wiseguy.template.Template,),
+        dict(
+            element=copy.deepcopy(template.element),
+            transforms=copy.deepcopy(list(template.transforms)),
+            anchors=template.pristine_anchors()))
+
+def run(name, template, number):
+    nodes = sum(1 for el in template.element.iter())
+    old = timeit.timeit(lambda: deepcopy_clone(template), number=number)
+    new = timeit.timeit(template.copy, number=number)
+    print "%-6s %5s nodes  deepcopy %8.1fus  clone %8.1fus  (%.1fx)" % (
+        name,
+        nodes,
+        old / number * 1e6,
+        new / number * 1e6,
+        old / new)
+
+if __name__ == '__main__':
+    run("small", make_template(2), 2000)
+    run("large", make_template(1250), 200)
@@ -22,7 +22,10 @@ setup(
     author_email='singletoned@gmail.com',
     url='http://singletoned.net',
     license='',
-    scripts=["wiseguy/scripts/parse_jade.py", "wiseguy/scripts/html2jade.py"],
+    scripts=[
+        "wiseguy/scripts/parse_jade.py",
+        "wiseguy/scripts/html2jade.py",
+        "wiseguy/scripts/analyse_templates.py"],
     packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
     include_package_data=True,
     zip_safe=False,
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import types
+
+import wiseguy.analysis
+import wiseguy.html
+import wiseguy.template
+
+
+class page(wiseguy.template.Template):
+    element = wiseguy.html.Html(
+        "<div><h1></h1><ul>%s</ul></div>" % ("<li></li>" * 10))
+    transforms = [
+        wiseguy.template.Transform(
+            "title",
+            wiseguy.template.set_text("h1", lambda title: title)),
+        wiseguy.template.Transform(
+            "old",
+            wiseguy.template.set_text(".sidebar", lambda old: old)),
+        wiseguy.template.Transform(
+            "item",
+            wiseguy.template.set_text("ul *", lambda item: item)),
+        wiseguy.template.Transform(
+            "first",
+            wiseguy.template.set_attr("li:first-child", "class", lambda first: first)),
+        wiseguy.template.Transform(
+            "other",
+            lambda template, other: None)]
+
+class widget(wiseguy.template.SubTemplate):
+    def title(context):
+        return "Widget"
+
+def test_analyse_template():
+    reports = wiseguy.analysis.analyse_template(
+        page, contexts=[dict(title="Hullo", item="Item")], many=5)
+    summary = [(r['path'], r['matches'], r['problems']) for r in reports]
+    assert summary == [
+        ("h1", 1, []),
+        (".sidebar", 0, ['dead']),
+        ("ul *", 10, ['many', 'scan']),
+        ("li:first-child", 1, ['unanchored']),
+        (None, None, ['opaque'])]
+    assert reports[0]['matched'] == 1
+    assert reports[2]['matched'] == 10
+    assert reports[1]['matched'] == 0
+    assert reports[0]['select_seconds'] > 0
+
+def test_analyse_template_inserted():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><ul></ul></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "old",
+                wiseguy.template.set_text(".old", lambda old: old)),
+            wiseguy.template.Transform(
+                "items",
+                wiseguy.template.add("ul", lambda items: items)),
+            wiseguy.template.Transform(
+                "selected",
+                wiseguy.template.set_attr("li", "class", lambda selected: selected)),
+            wiseguy.template.Transform(
+                "link",
+                wiseguy.template.set_attr("div :first-child", "class", lambda link: link))]
+
+    reports = wiseguy.analysis.analyse_template(template)
+    # The li elements are only there once the ul has been added to
+    summary = [(r['path'], r['problems']) for r in reports]
+    assert summary == [
+        (".old", ['dead']),
+        ("ul", []),
+        ("li", []),
+        ("div :first-child", ['scan', 'unanchored'])]
+
+def test_analyse_template_set_attr():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p></p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "active",
+                wiseguy.template.set_attr("p", "class", lambda active: active)),
+            wiseguy.template.Transform(
+                "text",
+                wiseguy.template.set_text(".active", lambda text: text)),
+            wiseguy.template.Transform(
+                "title",
+                wiseguy.template.set_text("[title]", lambda title: title))]
+
+    reports = wiseguy.analysis.analyse_template(template)
+    # Setting the class can make .active match, but not [title]
+    summary = [(r['path'], r['problems']) for r in reports]
+    assert summary == [
+        ("p", []),
+        (".active", []),
+        ("[title]", ['dead'])]
+
+def test_analyse_module():
+    module = types.ModuleType("templates")
+    module.page = page
+    module.alias = page
+    module.widget = widget
+    module.Template = wiseguy.template.Template
+    assert wiseguy.analysis.templates(module) == [page, widget]
+    reports = wiseguy.analysis.analyse_module(module)
+    assert set(r['template'] for r in reports) == set(["page"])
+    assert "\tdead" in wiseguy.analysis.format_report(reports[1])
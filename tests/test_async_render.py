@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import py.test
+
+import wiseguy.async_render
+import wiseguy.html
+import wiseguy.template
+
+
+def get_asyncio():
+    try:
+        return wiseguy.async_render._asyncio()
+    except ImportError:
+        py.test.skip("Needs asyncio or trollius")
+
+
+class template(wiseguy.template.Template):
+    element = wiseguy.html.Html("<p></p>")
+    transforms = [
+        wiseguy.template.Transform(
+            "text",
+            wiseguy.template.set_text("p", lambda text: text))]
+
+
+def test_AsyncRenderer():
+    asyncio = get_asyncio()
+    loop = asyncio.new_event_loop()
+    try:
+        renderer = wiseguy.async_render.AsyncRenderer(max_concurrent=2, loop=loop)
+        futures = [renderer.render(template, text=str(i)) for i in range(5)]
+        assert renderer.running == 2
+        assert len(renderer.waiting) == 3
+        results = loop.run_until_complete(asyncio.gather(*futures, loop=loop))
+        assert results == ["<p>%s</p>\n" % i for i in range(5)]
+        assert renderer.running == 0
+    finally:
+        loop.close()
+
+def test_AsyncRenderer_cancel():
+    asyncio = get_asyncio()
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def slow():
+        started.set()
+        release.wait(5)
+        calls.append("slow")
+        return "slow"
+    def fast():
+        calls.append("fast")
+        return "fast"
+    try:
+        renderer = wiseguy.async_render.AsyncRenderer(max_concurrent=1, loop=loop)
+        first = renderer.submit(slow)
+        second = renderer.submit(fast)
+        third = renderer.submit(fast)
+        second.cancel()
+        started.wait(5)
+        release.set()
+        assert loop.run_until_complete(third) == "fast"
+        assert first.result() == "slow"
+        assert second.cancelled()
+        assert calls == ["slow", "fast"]
+    finally:
+        loop.close()
+
+def test_AsyncRenderer_cancel_running():
+    asyncio = get_asyncio()
+    loop = asyncio.new_event_loop()
+    release = threading.Event()
+    calls = []
+    def slow():
+        release.wait(5)
+        calls.append("slow")
+        return "slow"
+    def fast():
+        calls.append("fast")
+        return "fast"
+    try:
+        renderer = wiseguy.async_render.AsyncRenderer(max_concurrent=1, loop=loop)
+        first = renderer.submit(slow)
+        second = renderer.submit(fast)
+        first.cancel()
+        loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+        # The cancelled render is still running, so holds its slot
+        assert renderer.running == 1
+        assert calls == []
+        release.set()
+        assert loop.run_until_complete(second) == "fast"
+        assert first.cancelled()
+        assert calls == ["slow", "fast"]
+    finally:
+        loop.close()
+
+def test_AsyncRenderer_exception():
+    asyncio = get_asyncio()
+    loop = asyncio.new_event_loop()
+    try:
+        renderer = wiseguy.async_render.AsyncRenderer(loop=loop)
+        future = renderer.submit(lambda: 1/0)
+        py.test.raises(ZeroDivisionError, loop.run_until_complete, future)
+    finally:
+        loop.close()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import wiseguy.caching
+
+
+def test_LRUCache():
+    cache = wiseguy.caching.LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == dict(hits=3, misses=1, evictions=1, entries=2, bytes=0)
+
+def test_LRUCache_max_bytes():
+    cache = wiseguy.caching.LRUCache(max_bytes=10)
+    cache.set("a", "12345")
+    cache.set("b", "12345")
+    assert cache.size == 10
+    cache.set("c", "123")
+    assert "a" not in cache
+    assert cache.size == 8
+    cache.set("d", "12345678901")
+    assert "d" not in cache
+    assert len(cache) == 2
+
+def test_LRUCache_ttl():
+    now = [100]
+    cache = wiseguy.caching.LRUCache(ttl=10, clock=lambda: now[0])
+    cache.set("a", 1)
+    now[0] = 109
+    assert cache.get("a") == 1
+    now[0] = 110
+    assert cache.get("a") is None
+    assert len(cache) == 0
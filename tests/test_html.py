@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import threading
+
+import py.test
 import pyjade
 
 import wiseguy as wg
@@ -112,6 +115,10 @@ html
 </body></html>'''.strip()
     assert expected == result
 
+    element = wg.html.Html("<p><b>Bold</b> then <i>gone</i></p>")
+    element.replace("i", "text")
+    assert element.to_string(pretty=False) == "<p><b>Bold</b> then text</p>"
+
 def test_template_add_class():
     element = wg.html.jade("div: span.foo")
     element.add_class("span", "foo")
@@ -235,3 +242,88 @@ def test_HtmlElement():
     result = h.DIV(
         wg.html.Html("<br>").join(data)).to_string().strip()
     assert expected == result
+
+def test_select():
+    element = wg.html.Html(
+        '<div class="x"><p id="foo" class="x y">One</p><p class="yy">Two</p>'
+        '<span class="y"><p>Three</p></span></div>')
+    for path in ["p", "P", "div", "#foo", ".y", "p.y", "p.x", "span p", "div > p", "p:first-child"]:
+        assert wg.html.select(element, path) == element.cssselect(path)
+
+    stats = wg.html.selector_stats()
+    wg.html.select(element, "span p")
+    assert wg.html.selector_stats()['hits'] == stats['hits'] + 1
+    assert wg.html.compiled_selector("span p") is wg.html.compiled_selector("span p")
+
+def test_batch():
+    element = wg.html.Html(
+        '<div><p class="a">One</p><p>Two</p><span><b>Three</b></span></div>')
+    element.batch([
+        ("p", "add_class", "para"),
+        ("p.a", "set_attr", ("title", "First")),
+        ("p", "after", "!"),
+        ("span", "extract", None),
+        ("b", "replace", wg.html.Html("<i>Three</i>")),
+        ("p.a", "add", " more"),
+        # Matched before the batch, so the class added above doesn't count
+        (".para", "set_attr", ("title", "Para"))])
+    expected = (
+        '<div><p class="a para" title="First">One more</p>!'
+        '<p class="para">Two</p>!<i>Three</i></div>')
+    assert element.to_string(pretty=False) == expected
+
+    with py.test.raises(ValueError):
+        element.batch([("p", "remove", None)])
+
+def test_enable_index():
+    element = wg.html.Html(
+        '<div><p class="a" id="first">One</p><p class="b">Two</p></div>')
+    index = wg.html.enable_index(element)
+    assert not index.built
+    assert [el.text for el in wg.html.select(element, ".a")] == ["One"]
+    assert index.built
+
+    element.add_class("p.b", "a")
+    element.add("div", wg.html.Html('<span class="a">Three</span>'), index=0)
+    element.set_attr("#first", "id", "second")
+    assert [el.text for el in wg.html.select(element, ".a")] == ["Three", "One", "Two"]
+    assert [el.text for el in wg.html.select(element, "p.a")] == ["One", "Two"]
+    assert wg.html.select(element, "#first") == []
+    assert [el.text for el in wg.html.select(element, "#second")] == ["One"]
+
+    element.replace("span", "Four")
+    element.extract("#second")
+    assert [el.text for el in wg.html.select(element, ".a")] == ["Two"]
+    assert wg.html.select(element, "#second") == []
+
+def test_Html_encoding():
+    src = u'<p>Caf\xe9</p>'
+    assert wg.html.Html(src.encode('utf-8'), encoding='utf-8').text == u'Caf\xe9'
+    assert wg.html.Html(src, encoding='utf-8').text == u'Caf\xe9'
+
+def test_get_parser():
+    parsers = []
+    thread = threading.Thread(target=lambda: parsers.append(wg.html.get_parser()))
+    thread.start()
+    thread.join()
+    assert parsers[0] is not wg.html.get_parser()
+    assert wg.html.get_parser() is wg.html.get_parser()
+    assert isinstance(parsers[0].makeelement('p'), wg.html.HtmlElement)
+    assert isinstance(wg.html.parser.makeelement('p'), wg.html.HtmlElement)
+
+def test_fragment_cache():
+    assert wg.html.fragment_cache_stats() is None
+    wg.html.enable_fragment_cache(max_entries=1)
+    try:
+        first = wg.html.Html('<p class="a">One</p>')
+        first.add_class("", "b")
+        second = wg.html.Html('<p class="a">One</p>')
+        assert second is not first
+        assert second.to_string(pretty=False) == '<p class="a">One</p>'
+        assert isinstance(second, wg.html.HtmlElement)
+        wg.html.Html('<p>Two</p>')
+        stats = wg.html.fragment_cache_stats()
+        assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 2, 1)
+        assert stats['hit_rate'] == 1.0 / 3
+    finally:
+        wg.html.disable_fragment_cache()
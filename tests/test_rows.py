@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import collections
+
+import lxml.html
+import py.test
+
+import wiseguy.html
+import wiseguy.rows
+import wiseguy.template
+
+
+class row(wiseguy.rows.RowTemplate):
+    element = wiseguy.html.Html(
+        '<tr><td class="name"></td><td><a class="link"></a></td></tr>')
+    fields = [
+        ("name", ".name"),
+        ("url", "a.link", "href"),
+        ("name", "a.link")]
+
+def test_RowTemplate():
+    assert row.names == ("name", "url")
+    expected = (
+        '<tr><td class="name">Foo &amp; Bar</td>'
+        '<td><a class="link" href="/foo">Foo &amp; Bar</a></td></tr>')
+    record = dict(name="Foo & Bar", url="/foo")
+    assert row.render([record]) == expected
+    assert lxml.html.tostring(row.make_element(record)) == expected
+
+    Record = collections.namedtuple("Record", "url name")
+    records = [("Foo & Bar", "/foo"), Record("/foo", "Foo & Bar"), record]
+    assert row.render(records) == expected * 3
+    columns = dict(name=["Foo & Bar", "Foo & Bar"], url=["/foo", "/foo"])
+    assert row.render(row.from_columns(columns)) == expected * 2
+
+    chunks = list(row.render_iter(iter([record] * 5), chunk_size=2))
+    assert chunks == [expected * 2, expected * 2, expected]
+
+def test_RowTemplate_escaping():
+    for url in ['/a"b', '/a b', u'/caf\xe9', '/?a=1&b=<2>', '  /lead']:
+        for title in ['a"b', "a'\"b", u'caf\xe9 & <co>']:
+            record = dict(name=title, url=url)
+            html = row.render([record])
+            assert html == lxml.html.tostring(row.make_element(record))
+    assert 'href="/a%22b"' in row.render([dict(name="", url='/a"b')])
+
+def test_RowTemplate_same_node():
+    with py.test.raises(ValueError) as error:
+        class clashing(wiseguy.rows.RowTemplate):
+            element = wiseguy.html.Html('<p><span></span></p>')
+            fields = [("a", "span"), ("b", "span")]
+    assert "Fields a and b both set the text of span" in str(error.value)
+
+    with py.test.raises(ValueError):
+        class boolean(wiseguy.rows.RowTemplate):
+            element = wiseguy.html.Html('<p><input></p>')
+            fields = [("checked", "input", "checked")]
+
+def test_add_rows():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html(
+            "<table><thead></thead><tbody><tr><td>Last</td></tr></tbody></table>")
+        transforms = [
+            wiseguy.template.Transform(
+                "records",
+                wiseguy.rows.add_rows("tbody", row, lambda records: records, index=0)),
+            wiseguy.template.Transform(
+                "highlight",
+                wiseguy.template.set_attr(".name", "class", lambda highlight: highlight))]
+
+    records = (dict(name=name, url="/" + name) for name in ["Foo", "Bar"])
+    element = template.render_lxml(dict(records=records, highlight="highlight"))
+    assert [el.text for el in element.cssselect("tbody td")] == ["Foo", None, "Bar", None, "Last"]
+    assert len(element.cssselect("td.highlight")) == 2
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import wiseguy.html
+import wiseguy.selectors
+
+
+def test_Selector():
+    selector = wiseguy.selectors.Selector("div > a.foo#bar[href]")
+    assert selector.simple
+    assert selector.attributes == set(["id", "class", "href"])
+
+    element = wiseguy.html.Html(
+        "<div><a class='foo' id='bar' href='#'></a><p><a class='foo' id='bar' href='#'></a></p></div>")
+    first, second = element.xpath("//a")
+    assert selector.subject_matches(first)
+    assert selector.subject_matches(second)
+    assert selector.matches(first, element)
+    assert not selector.matches(second, element)
+
+def test_Selector_descendant():
+    selector = wiseguy.selectors.Selector("div p, span")
+    element = wiseguy.html.Html("<div><section><p></p></section><span></span></div>")
+    p = element.xpath("//p")[0]
+    span = element.xpath("//span")[0]
+    assert selector.matches(p, element)
+    assert selector.matches(span, element)
+    assert not selector.matches(p, p)
+
+def test_Selector_not_simple():
+    for path in ["p:first-child", "p + p", "a[href^='http']", "p::first-line"]:
+        selector = wiseguy.selectors.Selector(path)
+        assert not selector.simple
@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import multiprocessing.pool
+import threading
+
+import py.test
+
 import wiseguy.template
+import wiseguy.transforms
 import wiseguy.html
 import wiseguy.utils
+import wiseguy.caching
+import wiseguy.tracing
 
 
 def test_Transform():
@@ -36,11 +44,11 @@ html
     assert template.element
     assert template.transforms
     assert len(template.transforms) == 3
-    assert len(template.applied_transforms) == 0
 
     context = dict(body="Foo")
 
-    template.apply(context)
+    with wiseguy.tracing.tracing() as trace:
+        template.apply(context)
     assert template.keys() == set(["head"])
 
     html = template.element.to_string().strip()
@@ -55,10 +63,11 @@ html
     assert html == expected
 
     assert len(template.transforms) == 1
-    assert len(template.applied_transforms) == 2
+    assert len(trace) == 2
 
     context = dict(body="Bar", head=None)
-    template.apply(context)
+    with wiseguy.tracing.tracing(trace):
+        template.apply(context)
     assert template.keys() == set()
 
     html = template.element.to_string().strip()
@@ -73,7 +82,7 @@ html
     assert html == expected
 
     assert len(template.transforms) == 0
-    assert len(template.applied_transforms) == 3
+    assert len(trace) == 3
 
 def test_Template_multi_transform():
     class template(wiseguy.template.Template):
@@ -355,3 +364,798 @@ div
     span wobble
     span wibble''').normalise()
     assert result == expected
+
+def test_anchors():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html(
+            "<html><head><title></title></head><body><div class='main'></div></body></html>")
+        transforms = [
+            wiseguy.template.Transform(
+                "title",
+                wiseguy.template.set_text("title", lambda title: title)),
+            wiseguy.template.Transform(
+                "body",
+                wiseguy.template.add(".main", lambda body: wiseguy.html.Html(body))),
+            wiseguy.template.Transform(
+                "link",
+                wiseguy.template.set_attr("a", "href", lambda link: link))]
+
+    anchors = template.anchors.anchors
+    assert anchors.positions == {
+        "title": [(0, 0)],
+        ".main": [(1, 0)],
+        "a": []}
+
+    element = template.render_lxml(
+        dict(title="Hullo", body="<p><a>Link</a></p>", link="/flibble"))
+    result = element.to_string(pretty=False)
+    expected = '<html><head><title>Hullo</title></head><body><div class="main"><p><a href="/flibble">Link</a></p></div></body></html>'
+    assert result == expected
+
+    element = template.render_lxml(dict(title="Hullo", body="<p>Para</p>", link="/flibble"))
+    result = element.to_string(pretty=False)
+    expected = '<html><head><title>Hullo</title></head><body><div class="main"><p>Para</p></div></body></html>'
+    assert result == expected
+    assert template.anchors.clean
+
+def test_anchors_attribute_change():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p></p><p class='foo'></p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "cls",
+                wiseguy.template.set_attr("p", "class", lambda cls: cls)),
+            wiseguy.template.Transform(
+                ("cls", "text"),
+                wiseguy.template.set_text(".bar", lambda cls, text: text))]
+
+    result = template.render_lxml(dict(cls="bar", text="Hullo")).to_string(pretty=False)
+    expected = '<div><p class="bar">Hullo</p><p class="bar">Hullo</p></div>'
+    assert result == expected
+
+def test_anchors_replace():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p class='foo'><span></span></p><span></span></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "foo",
+                wiseguy.template.replace(".foo", lambda foo: wiseguy.html.Html(foo))),
+            wiseguy.template.Transform(
+                ("foo", "text"),
+                wiseguy.template.set_text("span", lambda foo, text: text))]
+
+    result = template.render_lxml(dict(foo="<b>Bold</b>", text="Hullo")).to_string(pretty=False)
+    expected = '<div><b>Bold</b><span>Hullo</span></div>'
+    assert result == expected
+
+    result = template.render_lxml(dict(foo="<i><span></span></i>", text="Hullo")).to_string(pretty=False)
+    expected = '<div><i><span>Hullo</span></i><span>Hullo</span></div>'
+    assert result == expected
+
+def test_anchors_tainted():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p></p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "extra",
+                lambda template, extra: template.element.add("div", wiseguy.html.Html(extra))),
+            wiseguy.template.Transform(
+                ("extra", "text"),
+                wiseguy.template.set_text("p", lambda extra, text: text))]
+
+    result = template.render_lxml(dict(extra="<p></p>", text="Hullo")).to_string(pretty=False)
+    expected = '<div><p>Hullo</p><p>Hullo</p></div>'
+    assert result == expected
+
+def test_anchors_insert_index():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p></p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "a",
+                wiseguy.template.add("div", lambda a: wiseguy.html.Html("<span>x</span>"), index=0)),
+            wiseguy.template.Transform(
+                "b",
+                wiseguy.template.set_text("p", lambda b: b))]
+
+    template.apply(dict(a=1))
+    assert not template.anchors.clean
+    result = template.render_lxml(dict(b="hi")).to_string(pretty=False)
+    assert result == '<div><span>x</span><p>hi</p></div>'
+
+def test_Template_apply_key_index():
+    calls = []
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "a",
+                lambda template, a: calls.append(("a", a))),
+            wiseguy.template.Transform(
+                ("a", "b"),
+                lambda template, a, b: calls.append(("ab", a, b))),
+            wiseguy.template.Transform(
+                "c",
+                lambda template, c: calls.append(("c", c))),
+            wiseguy.template.Transform(
+                "b",
+                lambda template, b: calls.append(("b", b)))]
+
+    untouched = template.transforms[2]
+    template.apply(dict(b=2, z=0))
+    assert calls == [("b", 2)]
+    assert len(template.transforms) == 3
+    assert template.transforms[2] is untouched
+    assert template.transforms[1].context == dict(b=2)
+    assert template.keys() == set(["a", "c"])
+
+    template.apply(dict(a=1, c=3))
+    assert calls == [("b", 2), ("a", 1), ("ab", 1, 2), ("c", 3)]
+    assert template.transforms == ()
+    assert template.keys() == set()
+
+def test_Template_shape_plan():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p></p><span></span></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "user",
+                wiseguy.template.set_text("p", lambda user: user)),
+            wiseguy.template.Transform(
+                ("user", "errors"),
+                wiseguy.template.add("span", lambda user, errors: errors)),
+            wiseguy.template.Transform(
+                "errors",
+                wiseguy.template.set_attr("span", "class", lambda errors: "error"))]
+
+    steps, fired = template.shape_plan(dict(user="Foo", request=None))
+    assert [(position, fires) for (position, transform, fires) in steps] == [
+        (0, True), (1, False)]
+    assert fired == (template.transforms[0],)
+    assert template.shape_plan(dict(user="Bar")) == (steps, fired)
+
+    assert template.render(user="Foo") == "<div>\n<p>Foo</p>\n<span></span>\n</div>\n"
+    assert template.render(user="Foo", errors="Oops") == (
+        '<div>\n<p>Foo</p>\n<span class="error">Oops</span>\n</div>\n')
+    # Renders apply copies, which share the plans of the template
+    assert len(template._shape_plans[1]) == 2
+
+def test_Template_shape_plan_shared():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p></p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "user",
+                wiseguy.template.set_text("p", lambda user: user))]
+
+    for user in ["Foo", "Bar", "Baz"]:
+        assert template.render(user=user) == "<div><p>%s</p></div>\n" % user
+    assert template.bake() is template
+    plans = template._shape_plans[1]
+    assert plans.stats()['misses'] == 1
+    assert plans.stats()['hits'] == 2
+
+def test_Template_bake():
+    stylesheet = wiseguy.transforms.add_stylesheet("foo.css")
+    script = wiseguy.transforms.add_script("foo.js")
+    late = wiseguy.template.Transform(
+        [],
+        wiseguy.template.add("ul", lambda: wiseguy.html.Html("<li>Last</li>")))
+
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html(
+            "<html><head></head><body><ul></ul></body></html>")
+        transforms = [
+            stylesheet,
+            wiseguy.template.Transform(
+                "items",
+                wiseguy.template.add_multiple("ul", lambda items: items)),
+            script,
+            late]
+
+    # Transforms after one that inserts content aren't baked, as they
+    # could match what it inserts
+    baked = template.bake()
+    assert baked.baked_transforms == (stylesheet,)
+    assert [t.keys for t in baked.transforms] == [set(["items"]), set(), set()]
+    assert len(baked.element.xpath("//head/*")) == 1
+    assert template.bake() is baked
+    assert len(template.transforms) == 4
+    assert len(template.element.xpath("//head/*")) == 0
+
+    result = template.render_lxml(
+        dict(items=[wiseguy.html.Html("<li>First</li>")])).to_string(pretty=False)
+    expected = '<html><head><link href="foo.css" type="text/css" rel="stylesheet"><script src="foo.js"></script></head><body><ul><li>First</li><li>Last</li></ul></body></html>'
+    assert result == expected
+
+def test_Template_bake_inserted():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><a></a><div id='main'></div></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "body",
+                wiseguy.template.add("#main", lambda body: wiseguy.html.Html(body))),
+            wiseguy.template.Transform(
+                [],
+                wiseguy.template.set_attr("a", "rel", lambda: "nofollow"))]
+
+    result = template.render_lxml(dict(body="<p><a></a></p>")).to_string(pretty=False)
+    expected = '<div><a rel="nofollow"></a><div id="main"><p><a rel="nofollow"></a></p></div></div>'
+    assert result == expected
+
+def test_Template_bake_replaced_text():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><ul></ul>T<p></p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "items",
+                wiseguy.template.set_text("ul", lambda items: items)),
+            wiseguy.template.Transform(
+                [],
+                wiseguy.template.replace("p", lambda: "txt"))]
+
+    # The text replacing the p goes on the tail of the ul
+    assert template.bake().baked_transforms == ()
+    result = template.render_lxml(dict(items="x")).to_string(pretty=False)
+    assert result == "<div><ul>x</ul>Ttxt</div>"
+
+def test_Template_bake_without_transforms():
+    class layout(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div></div>")
+
+    layout.transforms = [
+        wiseguy.template.Transform([], wiseguy.template.set_attr("div", "id", lambda: "main"))]
+    assert layout.render(**{}) == '<div id="main"></div>\n'
+
+def test_Template_serialization_plan():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html('''
+<html><head><title></title></head>
+<body><div id="nav"><a href="/">Home</a></div>
+<div id="main"><p class="intro"></p></div>
+<div id="footer"><img src="/logo.png"> Footer</div></body></html>''')
+        transforms = [
+            wiseguy.template.Transform(
+                "title",
+                wiseguy.template.set_text("title", lambda title: title)),
+            wiseguy.template.Transform(
+                "body",
+                wiseguy.template.add("#main", lambda body: wiseguy.html.Html(body))),
+            wiseguy.template.Transform(
+                "intro",
+                wiseguy.template.replace(".intro", lambda intro: intro))]
+
+    plan = template.serialization_plan()
+    assert plan.regions == [(0, 0), (1, 1)]
+    assert '<a href="/">Home</a>' in plan.static[1]
+
+    context = dict(title="Hullo", body="<p>Body</p>", intro="Intro")
+    expected = wiseguy.html.HtmlElement.to_string(template.render_lxml(context))
+    assert template.render(**context) == expected
+    assert "<title>Hullo</title>" in expected
+    assert "Intro<p>Body</p>" in expected
+
+    context = dict(title="Hullo")
+    expected = wiseguy.html.HtmlElement.to_string(template.render_lxml(context))
+    assert template.render(**context) == expected
+
+def test_Template_serialization_plan_opaque():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p></p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "p",
+                lambda template, p: template.element.add("p", p))]
+
+    assert template.serialization_plan() is None
+    assert template.render(p="Hullo") == "<div><p>Hullo</p></div>\n"
+
+def test_Template_render_iter():
+    rendered = []
+    def body(body):
+        rendered.append(body)
+        return wiseguy.html.Html(body)
+
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html('''
+<html><head><title></title></head>
+<body><div id="nav"></div><div id="main"></div></body></html>''')
+        transforms = [
+            wiseguy.template.Transform(
+                "title",
+                wiseguy.template.set_text("title", lambda title: title)),
+            wiseguy.template.Transform(
+                "body",
+                wiseguy.template.add("#main", body))]
+
+    context = dict(title="Hullo", body="<p>Body</p>")
+    chunks = template.render_iter(**context)
+    assert chunks.next().startswith("<html>")
+    assert "<title>Hullo</title>" in chunks.next()
+    assert rendered == []
+    rest = list(chunks)
+    assert rendered == ["<p>Body</p>"]
+    assert "".join(rest).endswith("</html>\n")
+
+    expected = template.render(**context)
+    assert "".join(template.render_iter(**context)) == expected
+    context = dict(body="<p>Body</p>")
+    assert "".join(template.render_iter(**context)) == template.render(**context)
+
+def test_Template_render_deferred():
+    slow = threading.Event()
+    def recommended(recommended):
+        slow.wait(5)
+        return wiseguy.html.Html("<ul><li>%s</li></ul>" % recommended)
+
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html('''
+<html><head><title></title></head>
+<body><div id="recommended"></div><div id="feed"><p></p></div></body></html>''')
+        transforms = [
+            wiseguy.template.Transform(
+                "title",
+                wiseguy.template.set_text("title", lambda title: title)),
+            wiseguy.template.Transform(
+                "recommended",
+                wiseguy.template.deferred(
+                    wiseguy.template.add("#recommended", recommended))),
+            wiseguy.template.Transform(
+                "feed",
+                wiseguy.template.deferred(
+                    wiseguy.template.replace("#feed p", lambda feed: feed)))]
+
+    context = dict(title="Hullo", recommended="Foo", feed="<Feed>")
+    chunks = []
+    for chunk in template.render_deferred(context):
+        chunks.append(chunk)
+        if 'id="wiseguy-deferred-1"' in chunk:
+            slow.set()
+    html = "".join(chunks)
+    assert '<div id="recommended"><template data-wiseguy-deferred="0.0"></template></div>' in html
+    assert '<title>Hullo</title>' in html
+    assert html.index("wiseguy-deferred-1\">&lt;Feed&gt;</template>") < html.index(
+        "wiseguy-deferred-0\"><ul><li>Foo</li></ul></template>")
+    assert chunks[-1] == "</body>\n</html>\n"
+
+    html = template.render(**context)
+    assert '<div id="recommended"><ul><li>Foo</li></ul></div>' in html
+
+    with py.test.raises(ValueError):
+        wiseguy.template.deferred(wiseguy.template.set_text("p", lambda: ""))
+
+def test_Template_render_deferred_later():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html('''
+<html><head><title></title></head>
+<body><div id="rec"></div><ul><li>b</li></ul></body></html>''')
+        transforms = [
+            wiseguy.template.Transform(
+                "rec",
+                wiseguy.template.deferred(wiseguy.template.add(
+                    "#rec",
+                    lambda rec: wiseguy.html.Html("<ul><li>%s</li></ul>" % rec)))),
+            wiseguy.template.Transform(
+                "on",
+                wiseguy.template.set_attr("li", "class", lambda on: on))]
+
+    context = dict(rec="a", on="on")
+    html = "".join(template.render_deferred(context))
+    assert 'wiseguy-deferred-0.0"><ul><li class="on">a</li></ul></template>' in html
+    assert '<li class="on">b</li>' in html
+    assert '<ul><li class="on">a</li></ul>' in template.render(**context)
+
+    html = "".join(template.render_deferred(dict(rec="a")))
+    assert 'wiseguy-deferred-0"><ul><li>a</li></ul></template>' in html
+
+def test_Template_render_fragment():
+    calls = []
+    def title(title):
+        calls.append(title)
+        return title
+
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html('''
+<html><head><title></title></head>
+<body class="search"><div id="results"><ul></ul></div></body></html>''')
+        transforms = [
+            wiseguy.template.Transform(
+                "title",
+                wiseguy.template.set_text("title", title)),
+            wiseguy.template.Transform(
+                "results",
+                wiseguy.template.add_multiple(
+                    ".search #results ul",
+                    lambda results: [
+                        wiseguy.html.Html("<li>%s</li>" % r) for r in results])),
+            wiseguy.template.Transform(
+                "selected",
+                wiseguy.template.set_attr("li", "class", lambda selected: selected))]
+
+    context = dict(title="Hullo", results=["Foo", "Bar"], selected="selected")
+    html = template.render_fragment("#results", context)
+    assert html == (
+        '<div id="results"><ul>\n'
+        '<li class="selected">Foo</li>\n'
+        '<li class="selected">Bar</li>\n'
+        '</ul></div>\n')
+    assert calls == []
+    template, indexes = template.fragment("#results")
+    assert template.element.tag == "html"
+    assert len(template.element) == 1
+
+    class opaque(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p></p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "p",
+                lambda template, p: template.element.add("p", p))]
+
+    assert opaque.fragment("p") is None
+    assert opaque.render_fragment("p", dict(p="Hullo")) == "<p>Hullo</p>\n"
+    assert opaque.render_fragment("span", dict(p="Hullo")) == ""
+
+def test_Template_render_fragment_snippet():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p class='x'>a</p><span class='y'></span></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "k",
+                wiseguy.template.set_text(".y", lambda k: k)),
+            wiseguy.template.Transform(
+                [],
+                wiseguy.template.set_attr(".foo", "class", lambda: "bar"))]
+
+    assert template.render_fragment(".x", dict()) == '<p class="x">a</p>\n'
+    assert template.render_fragment(".y", dict(k="hi")) == '<span class="y">hi</span>\n'
+    # The node is the one matched before any baked transforms
+    assert template.render_fragment(".foo", dict()) == ""
+
+    class baked(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p class='foo'>a</p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                [],
+                wiseguy.template.set_attr(".foo", "class", lambda: "bar"))]
+
+    assert baked.bake() is not baked
+    assert baked.render_fragment(".foo", dict()) == '<p class="bar">a</p>\n'
+
+def test_Template_render_fragment_removed():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p class='x'>a</p><span></span></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "k",
+                lambda template, k: template.element.replace(".x", "gone"))]
+
+    assert template.render(k=1).startswith("<div>gone")
+    assert template.render_fragment(".x", dict(k=1)) == ""
+
+def test_Template_render_context_keys():
+    # Contexts are passed as dicts, so keys can share the names of arguments
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<html><body><p></p><div></div></body></html>")
+        transforms = [
+            wiseguy.template.Transform(
+                "pool",
+                wiseguy.template.set_text("p", lambda pool: pool)),
+            wiseguy.template.Transform(
+                "path",
+                wiseguy.template.set_text("div", lambda path: path))]
+
+    context = dict(pool="Lido", path="/")
+    assert "".join(template.render_deferred(context)) == template.render(**context)
+    assert template.render_fragment("p", context) == "<p>Lido</p>\n"
+    assert template.render_fragment("div", context) == "<div>/</div>\n"
+
+def test_overlay():
+    class layout(wiseguy.template.Template):
+        element = wiseguy.html.Html('''
+<html><head><title></title></head>
+<body><div id="header"><h1>Default</h1></div><div id="main"></div></body></html>''')
+        transforms = [
+            wiseguy.template.Transform(
+                "title",
+                wiseguy.template.set_text("title", lambda title: title)),
+            wiseguy.template.Transform(
+                "body",
+                wiseguy.template.add("#main", lambda body: wiseguy.html.Html(body)))]
+
+    client = wiseguy.template.overlay(
+        layout,
+        wiseguy.template.Transform(
+            [], wiseguy.template.set_text("title", lambda: "Client")),
+        wiseguy.template.Transform(
+            [], wiseguy.template.set_text("#main", lambda: "Client ")))
+    assert client.element is layout.element
+    assert client.serialization_plan().static is layout.serialization_plan().static
+
+    context = dict(body="<p>Body</p>")
+    html = client.render(**context)
+    assert "<title>Client</title>" in html
+    assert '<div id="main">Client <p>Body</p>' in html
+    assert "<title></title>" in layout.render(**context)
+
+    header = wiseguy.template.overlay(
+        client,
+        wiseguy.template.Transform(
+            "heading",
+            wiseguy.template.set_text("h1", lambda heading: heading)))
+    assert header.serialization_plan().static is not layout.serialization_plan().static
+    html = header.render(heading="Client", **context)
+    assert "<h1>Client</h1>" in html
+    assert "<title>Client</title>" in html
+    assert "Default" in layout.render(**context)
+
+def test_Template_cache():
+    calls = []
+    def content(body):
+        calls.append(body)
+        return wiseguy.html.Html("<p>%s</p>" % body)
+
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "body",
+                wiseguy.template.add("div", content))]
+        cache = wiseguy.caching.LRUCache(max_entries=10)
+
+    assert template.render(body="Foo", unused=object()) == "<div><p>Foo</p></div>\n"
+    assert template.render(body="Foo", unused=object()) == "<div><p>Foo</p></div>\n"
+    assert template.render(body="Bar") == "<div><p>Bar</p></div>\n"
+    assert calls == ["Foo", "Bar"]
+
+    element = template.render_lxml(dict(body="Foo"))
+    element.add("p", "Changed")
+    result = template.render_lxml(dict(body="Foo")).to_string(pretty=False)
+    assert result == "<div><p>Foo</p></div>"
+    assert calls == ["Foo", "Bar", "Foo"]
+
+    assert template.render(body=bytearray("Baz")) == "<div><p>Baz</p></div>\n"
+    assert template.render(body=bytearray("Baz")) == "<div><p>Baz</p></div>\n"
+    assert template.cache.stats()['hits'] == 2
+    assert template.cache.stats()['misses'] == 3
+
+def test_Template_cache_types():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p></p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "n",
+                wiseguy.template.set_text("p", lambda n: repr(n))),
+            wiseguy.template.Transform(
+                "c",
+                wiseguy.template.add("div", lambda c: c))]
+        cache = wiseguy.caching.LRUCache(max_entries=10)
+
+    assert template.render(n=1) == "<div><p>1</p></div>\n"
+    assert template.render(n=True) == "<div><p>True</p></div>\n"
+    assert template.render(n=1.0) == "<div><p>1.0</p></div>\n"
+    assert template.render(n={"a": 1}) == "<div><p>{'a': 1}</p></div>\n"
+    assert template.render(n=[("a", 1)]) == "<div><p>[('a', 1)]</p></div>\n"
+    assert template.render(c="<b>x</b>") == "<div>\n<p></p>&lt;b&gt;x&lt;/b&gt;</div>\n"
+    assert template.render(c=wiseguy.html.Html("<b>x</b>")) == "<div>\n<p></p>\n<b>x</b>\n</div>\n"
+    assert template.cache.stats()['hits'] == 0
+
+def test_Template_cache_objects():
+    class User(object):
+        def __init__(self, name):
+            self.name = name
+
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<p></p>")
+        transforms = [
+            wiseguy.template.Transform(
+                "user",
+                wiseguy.template.set_text("p", lambda user: user.name))]
+        cache = wiseguy.caching.LRUCache(max_entries=10)
+
+    user = User("Alice")
+    assert template.render(user=user) == "<p>Alice</p>\n"
+    user.name = "Bob"
+    assert template.render(user=user) == "<p>Bob</p>\n"
+    assert template.cache_key(dict(user=user)) is None
+    assert len(template.cache) == 0
+
+def test_memoized_helpers():
+    calls = []
+    def options(selected):
+        calls.append(selected)
+        for value in ["a", "b"]:
+            option = wiseguy.html.Html("<option>%s</option>" % value)
+            if value == selected:
+                option.set("selected", "selected")
+            yield option
+
+    add_multiple = wiseguy.template.add_multiple("select", options, memoize=2)
+    for selected in ["a", "a", "b", "a"]:
+        template = wiseguy.utils.MockObject(
+            element=wiseguy.html.Html("<form><select></select></form>"))
+        add_multiple(template, selected=selected)
+        result = template.element.to_string(pretty=False)
+        expected = '<form><select><option%s>a</option><option%s>b</option></select></form>' % (
+            ' selected' if selected == "a" else '',
+            ' selected' if selected == "b" else '')
+        assert result == expected
+    assert calls == ["a", "b"]
+    assert add_multiple.content_func.cache.stats()['hits'] == 2
+
+    set_text = wiseguy.template.set_text("p", lambda text: text.upper(), memoize=True)
+    template = wiseguy.utils.MockObject(element=wiseguy.html.Html("<div><p></p></div>"))
+    set_text(template, text="hullo")
+    assert template.element.to_string(pretty=False) == "<div><p>HULLO</p></div>"
+
+def test_memoized_types():
+    memoized = wiseguy.template.memoized(lambda n: "%r" % (n,))
+    assert [memoized(n=n) for n in [1, True, 1.0, 1]] == ["1", "True", "1.0", "1"]
+    assert memoized.cache.stats()['hits'] == 1
+
+def test_Template_tracing():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<ul><li></li><li></li></ul>")
+        transforms = [
+            wiseguy.template.Transform(
+                ("text", "other"),
+                wiseguy.template.set_text("li", lambda text, other: text)),
+            wiseguy.template.Transform(
+                "text",
+                lambda template, text: None)]
+
+    template.render(text="Foo", other="Bar")
+
+    stats = wiseguy.tracing.enable_stats()
+    try:
+        with wiseguy.tracing.tracing(wiseguy.tracing.Trace(max_entries=3)) as trace:
+            template.render(text="Foo", other="Bar")
+            template.render(text="Foo", other="Bar")
+    finally:
+        wiseguy.tracing.disable_stats()
+    template.render(text="Foo", other="Bar")
+
+    assert trace.recorded == 4
+    assert trace.dropped == 1
+    entries = list(trace)
+    assert entries[-2]['template'] == "template"
+    assert entries[-2]['keys'] == ["other", "text"]
+    assert entries[-2]['path'] == "li"
+    assert entries[-2]['matches'] == 2
+    assert entries[-1]['path'] is None
+    assert entries[-1]['matches'] is None
+
+    exported = stats.export()['template']
+    assert exported['transforms'] == 4
+    assert exported['matches'] == 4
+    assert exported['by_transform']['li']['count'] == 2
+    assert exported['by_transform']['text']['count'] == 2
+
+def test_Template_render_many():
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<p></p>")
+        transforms = [
+            wiseguy.template.Transform(
+                "text",
+                wiseguy.template.set_text("p", lambda text: text))]
+
+    contexts = [dict(text=str(i)) for i in range(20)]
+    expected = ["<p>%s</p>\n" % i for i in range(20)]
+    assert list(template.render_many(contexts, pool=None)) == expected
+    assert list(template.render_many(contexts, workers=2, pool='thread')) == expected
+    assert list(template.render_many(iter(contexts), workers=2, chunk_size=3)) == expected
+    results = template.render_many(contexts, workers=2, pool='thread', ordered=False)
+    assert sorted(results) == sorted(expected)
+
+def test_SubTemplate_lazy():
+    calls = []
+    def make_value(name):
+        def _value(context):
+            calls.append(name)
+            return "%s %s" % (name, context['who'])
+        return _value
+
+    class master(wiseguy.template.SubTemplate):
+        used = staticmethod(make_value("used"))
+        unused = staticmethod(make_value("unused"))
+        constant = "constant"
+
+    class template(wiseguy.template.Template):
+        element = wiseguy.html.Html("<p></p>")
+        transforms = [
+            wiseguy.template.Transform(
+                "used",
+                wiseguy.template.set_text("p", lambda used: used))]
+
+    context = master(dict(who="Fred"))
+    assert len(context) == 3
+    assert "unused" in context
+    assert calls == []
+
+    assert template.render(**context) == "<p>used Fred</p>\n"
+    assert sorted(calls) == ["unused", "used"]
+
+    context = master(dict(who="Fred"))
+    assert template.render_lxml(context).to_string() == "<p>used Fred</p>\n"
+    assert context['used'] == "used Fred"
+    assert context.evaluated() == set(["used"])
+    assert calls[2:] == ["used"]
+
+def test_SubTemplate_prefetch():
+    release = threading.Event()
+    def slow(context):
+        release.wait(5)
+        return "slow"
+    def fast(context):
+        return "fast %s" % context['who']
+
+    class master(wiseguy.template.SubTemplate):
+        slow_value = staticmethod(slow)
+        fast_value = staticmethod(fast)
+        other_value = staticmethod(fast)
+
+    pool = multiprocessing.pool.ThreadPool(2)
+    try:
+        context = master.prefetch(
+            dict(who="Fred"),
+            keys=["slow_value", "fast_value"],
+            pool=pool,
+            deadline=0.2)
+        assert context['fast_value'] == "fast Fred"
+        py.test.raises(wiseguy.template.DeadlineExceeded, context.__getitem__, "slow_value")
+        assert context['other_value'] == "fast Fred"
+
+        release.set()
+        context = master.prefetch(dict(who="Fred"), pool=pool, deadline=5)
+        assert dict(context) == dict(
+            slow_value="slow", fast_value="fast Fred", other_value="fast Fred")
+    finally:
+        release.set()
+        pool.terminate()
+
+def test_flatten():
+    class base(wiseguy.template.Template):
+        element = wiseguy.html.Html(
+            "<html><head></head><body><div id='section'></div></body></html>")
+        transforms = [
+            wiseguy.template.Transform(
+                "section",
+                wiseguy.template.add("#section", lambda section: section))]
+
+    class widget(wiseguy.template.Template):
+        element = wiseguy.html.Html("<p class='widget'></p>")
+        transforms = [
+            wiseguy.template.Transform(
+                "text",
+                wiseguy.template.set_text(".widget", lambda text: text))]
+
+    class section(wiseguy.template.SubTemplate):
+        class section(wiseguy.template.Template):
+            element = wiseguy.html.Html("<div><div id='page'></div></div>")
+            transforms = [
+                wiseguy.template.Transform(
+                    "page",
+                    wiseguy.template.add("#page", lambda page: page)),
+                wiseguy.transforms.add_stylesheet("section.css")]
+
+    class page(wiseguy.template.SubTemplate):
+        page = widget
+        other = widget
+
+    flattened = wiseguy.template.flatten(base, section, page)
+    assert [t.keys for t in flattened.transforms] == [set(["text"])]
+    # The section's stylesheet is baked into the page it is extended into
+    assert len(flattened.baked_transforms) == 1
+    assert flattened.__dict__.get('_anchor_state') is None
+
+    @wiseguy.template.extends(base, section)
+    class decorated(wiseguy.template.SubTemplate):
+        page = widget
+
+    for template in (flattened, decorated):
+        result = template.render_lxml(dict(text="Hullo")).to_string(pretty=False)
+        expected = '<html><head><link href="section.css" type="text/css" rel="stylesheet"></head><body><div id="section"><div><div id="page"><p class="widget">Hullo</p></div></div></div></body></html>'
+        assert result == expected
+
+    chained = wiseguy.template.extends(
+        wiseguy.template.extends(base)(section))(page)
+    assert chained.render(text="Hullo") == flattened.render(text="Hullo")
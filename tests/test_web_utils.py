@@ -15,6 +15,7 @@ import path
 
 from wiseguy import web_utils as wu, utils
 import wiseguy.html
+import wiseguy.template
 
 @contextlib.contextmanager
 def raises(error):
@@ -183,6 +184,24 @@ def test_LxmlEnv():
     html = env.render("flam", dict()).strip()
     assert html == "<div>Flam Page wotsit</div>"
 
+def test_LxmlEnv_streamed():
+    class page(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><p></p><p class='foo'></p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "foo_var",
+                wiseguy.template.set_text(".foo", lambda foo_var: foo_var)),
+            wiseguy.template.Transform(
+                "pool",
+                wiseguy.template.set_text("p", lambda pool: pool))]
+    env = wu.LxmlEnv(utils.MockObject(page=page))
+    response = env.get_response("page", dict(foo_var="flibble"))
+    assert response.is_streamed
+    assert response.data == env.render("page", dict(foo_var="flibble"))
+
+    response = env.get_response("page", dict(foo_var="flibble", pool="Lido"))
+    assert "<p>Lido</p>" in response.data
+
 def test_JadeEnv():
     with path.create_temp_dir() as d:
         layout_content = """
@@ -427,6 +446,27 @@ def test_make_client_env():
     assert not "flibble" in result
     check_result(result)
 
+def test_make_client_lxml_env():
+    class page(wiseguy.template.Template):
+        element = wiseguy.html.Html("<div><h1>Default</h1><p></p></div>")
+        transforms = [
+            wiseguy.template.Transform(
+                "foo_var",
+                wiseguy.template.set_text("p", lambda foo_var: foo_var))]
+    templates = utils.MockObject(page=page, other=page)
+    overrides = utils.MockObject(page=[
+        wiseguy.template.Transform(
+            [], wiseguy.template.set_text("h1", lambda: "Mr Flibble"))])
+
+    env = wu.make_client_lxml_env(templates, overrides)
+    html = env.render("page", dict(foo_var="flangit"))
+    assert "<h1>Mr Flibble</h1>" in html
+    assert "<p>flangit</p>" in html
+    assert "Default" in env.render("other", dict(foo_var="flangit"))
+    assert env.env.page is env.env.page
+    with raises(wu.TemplateNotFound):
+        env.render("missing", dict())
+
 def test_Controller():
     class FooController(wu.Controller):
         url_map = wu.UrlMap()
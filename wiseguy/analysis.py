@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import timeit
+
+import cssselect
+
+import wiseguy.selectors
+import wiseguy.template
+import wiseguy.tracing
+
+
+def _narrowed(tree):
+    "Does the compound selector ``tree`` name a tag, id or class?"
+    kind = type(tree).__name__
+    if kind == 'Element':
+        return bool(tree.element) and (tree.element != '*')
+    if kind in ('Hash', 'Class'):
+        return True
+    inner = getattr(tree, 'selector', None)
+    return (inner is not None) and _narrowed(inner)
+
+def _scans(path):
+    # Without a tag, id or class to go on, a subject under a descendant
+    # combinator has to be tested against every node below its ancestor
+    for parsed in cssselect.parse(path):
+        tree = parsed.parsed_tree
+        if (type(tree).__name__ == 'CombinedSelector') and (tree.combinator == ' '):
+            if not _narrowed(tree.subselector):
+                return True
+    return False
+
+def _select_seconds(element, path, repeat):
+    timer = timeit.Timer(lambda: element.cssselect(path))
+    return min(timer.repeat(repeat, 1))
+
+def _could_match(transforms):
+    """For each of ``transforms``, could one before it have made its
+    path match nodes the template element doesn't have?"""
+    could = []
+    inserted = False
+    attributes = set()
+    for (number, transform) in enumerate(transforms):
+        path = getattr(transform.action, 'path', None)
+        try:
+            selector = path and wiseguy.selectors.Selector(path)
+        except cssselect.SelectorError:
+            selector = None
+        if not selector:
+            could.append(inserted)
+        elif not selector.simple:
+            # Other pseudo-classes can depend on text or any attribute
+            could.append(bool(number))
+        else:
+            could.append(inserted or bool(attributes & selector.attributes))
+        action = transform.action
+        if (path is None) or getattr(action, 'inserts', False):
+            inserted = True
+        attribute = getattr(action, 'attribute', None)
+        if attribute is not None:
+            attributes.add(attribute)
+    return could
+
+def analyse_template(template, contexts=(), many=50, repeat=5):
+    """A report on each transform of ``template``: how many nodes its
+    path matches in the template's element, how long matching it with
+    cssselect takes, and any problems found.  Problems are 'dead' for a
+    path matching nothing in the template element, where no transform
+    before it (an add, replace or opaque action, or a set_attr of an
+    attribute the path tests) could make it match, 'many' for one matching more than ``many`` nodes, 'scan'
+    for one whose subject is under a descendant combinator with no
+    tag, id or class, so has to test every node below some ancestor,
+    'unanchored' for one that is matched with cssselect on every
+    render, 'opaque' for an action with no path and 'invalid' for a
+    path that isn't a selector.  If ``contexts`` are given, the
+    template is rendered with each of them, and the transforms that
+    are applied get the total ``seconds`` taken and nodes ``matched``."""
+    element = getattr(template, 'element', None)
+    reports = []
+    could = _could_match(template.transforms)
+    for transform, matchable in zip(template.transforms, could):
+        path = getattr(transform.action, 'path', None)
+        report = dict(
+            template=template.__name__,
+            keys=sorted(transform.keys),
+            path=path,
+            matches=None,
+            select_seconds=None,
+            problems=[])
+        reports.append(report)
+        if path is None:
+            report['problems'].append('opaque')
+            continue
+        if (element is None) or not path:
+            continue
+        try:
+            selector = wiseguy.selectors.Selector(path)
+            report['matches'] = len(element.cssselect(path))
+        except cssselect.SelectorError:
+            report['problems'].append('invalid')
+            continue
+        report['select_seconds'] = _select_seconds(element, path, repeat)
+        if not (report['matches'] or matchable):
+            report['problems'].append('dead')
+        elif report['matches'] > many:
+            report['problems'].append('many')
+        if _scans(path):
+            report['problems'].append('scan')
+        if not selector.simple:
+            report['problems'].append('unanchored')
+    if contexts and (element is not None):
+        _measure(template, contexts, reports)
+    return reports
+
+def _measure(template, contexts, reports):
+    with wiseguy.tracing.tracing(wiseguy.tracing.Trace(max_entries=None)) as trace:
+        for context in contexts:
+            template.render(**context)
+    by_path = dict()
+    for entry in trace:
+        totals = by_path.setdefault(entry['path'], dict(seconds=0.0, matched=0))
+        totals['seconds'] = totals['seconds'] + entry['seconds']
+        totals['matched'] = totals['matched'] + (entry['matches'] or 0)
+    for report in reports:
+        report.update(by_path.get(report['path'], dict(seconds=0.0, matched=0)))
+
+def templates(module):
+    "The templates and sub templates in ``module``"
+    found = []
+    for name, value in sorted(vars(module).iteritems()):
+        if not isinstance(value, wiseguy.template.TemplateMeta):
+            continue
+        if value in (wiseguy.template.Template, wiseguy.template.SubTemplate):
+            continue
+        if not value in found:
+            found.append(value)
+    return found
+
+def analyse_module(module, contexts=None, many=50, repeat=5):
+    """Reports on the transforms of every template in ``module``, with
+    ``contexts`` mapping template names to contexts to measure them with"""
+    if contexts is None:
+        contexts = dict()
+    reports = []
+    for template in templates(module):
+        reports.extend(analyse_template(
+            template,
+            contexts.get(template.__name__, ()),
+            many=many,
+            repeat=repeat))
+    return reports
+
+def format_report(report):
+    if report['select_seconds'] is None:
+        seconds = "-"
+    else:
+        seconds = "%.1fus" % (report['select_seconds'] * 1000000)
+    return "%s\t%s\t%s\t%s\t%s\t%s" % (
+        report['template'],
+        ",".join(report['keys']),
+        report['path'],
+        report['matches'],
+        seconds,
+        " ".join(report['problems']))
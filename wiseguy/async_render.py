@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import collections, functools
+
+
+def _asyncio():
+    try:
+        import asyncio
+    except ImportError:
+        import trollius as asyncio
+    return asyncio
+
+
+class AsyncRenderer(object):
+    """Runs renders on an executor, returning futures that an event loop
+    can wait on without being blocked by the copy, apply and serialise
+    work.  At most ``max_concurrent`` renders are handed to the executor
+    at once; the rest wait in order.  Cancelling a waiting render means
+    it never runs.  A running one can't be stopped, so cancelling it
+    discards its result, but it keeps its place among the
+    ``max_concurrent`` until it finishes.
+
+    ``executor`` defaults to the event loop's default executor.
+    """
+
+    def __init__(self, executor=None, max_concurrent=4, loop=None):
+        self.executor = executor
+        self.max_concurrent = max_concurrent
+        self.loop = loop
+        self.running = 0
+        self.waiting = collections.deque()
+
+    def submit(self, func, *args, **kwargs):
+        asyncio = _asyncio()
+        loop = self.loop or asyncio.get_event_loop()
+        future = asyncio.Future(loop=loop)
+        self.waiting.append((future, functools.partial(func, *args, **kwargs)))
+        self._start(loop)
+        return future
+
+    def _start(self, loop):
+        while self.waiting and (self.running < self.max_concurrent):
+            future, func = self.waiting.popleft()
+            if future.cancelled():
+                continue
+            self.running = self.running + 1
+            inner = loop.run_in_executor(self.executor, func)
+            inner.add_done_callback(
+                functools.partial(self._finished, loop, future))
+
+    def _finished(self, loop, future, inner):
+        self.running = self.running - 1
+        if not future.done():
+            if inner.cancelled():
+                future.cancel()
+            elif inner.exception() is not None:
+                future.set_exception(inner.exception())
+            else:
+                future.set_result(inner.result())
+        self._start(loop)
+
+    def render(self, template, **kwargs):
+        "A future for ``template.render(**kwargs)``"
+        return self.submit(template.render, **kwargs)
+
+    def render_env(self, env, template_name, context=None):
+        "A future for ``env.render(template_name, context)``, eg for an ``LxmlEnv``"
+        if context is None:
+            context = dict()
+        return self.submit(env.render, template_name, context)
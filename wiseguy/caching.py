@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import collections, threading, time
+
+
+class LRUCache(object):
+    """A thread safe least-recently-used cache, bounded by the number of
+    entries and optionally by their total size, with an optional time
+    to live in seconds."""
+
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None, sizeof=len, clock=time.time):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses = self.misses + 1
+                return default
+            value, size, expires = entry
+            if (expires is not None) and (expires <= self.clock()):
+                self.size = self.size - size
+                self.misses = self.misses + 1
+                return default
+            self.entries[key] = entry
+            self.hits = self.hits + 1
+            return value
+
+    def set(self, key, value, size=None):
+        if self.max_bytes is None:
+            size = 0
+        elif size is None:
+            size = self.sizeof(value)
+        if (self.max_bytes is not None) and (size > self.max_bytes):
+            return
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = self.clock() + self.ttl
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size = self.size - old[1]
+            self.entries[key] = (value, size, expires)
+            self.size = self.size + size
+            while (len(self.entries) > self.max_entries) or (
+                    (self.max_bytes is not None) and (self.size > self.max_bytes)):
+                old_key, old = self.entries.popitem(last=False)
+                self.size = self.size - old[1]
+                self.evictions = self.evictions + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self.entries),
+            bytes=self.size)
@@ -1,14 +1,222 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import itertools
 import types
 import copy
+import re
+import threading
+import weakref
 
-import lxml.html, lxml.builder
+import lxml.etree, lxml.html, lxml.builder, lxml.cssselect
 
+import wiseguy.caching
 import wiseguy.utils
 import wiseguy.html_tidy
 
 
+selector_cache = wiseguy.caching.LRUCache(max_entries=1000)
+
+_tag_re = re.compile(r"^([a-zA-Z][a-zA-Z0-9]*)$")
+_tag_class_re = re.compile(r"^([a-zA-Z][a-zA-Z0-9]*)\.([a-zA-Z_][\w-]*)$")
+_id_re = re.compile(r"^#([a-zA-Z_][\w-]*)$")
+_class_re = re.compile(r"^\.([a-zA-Z_][\w-]*)$")
+
+def _select_tag(tag):
+    def _select(element):
+        return list(element.iter(tag))
+    return _select
+
+def _select_tag_class(tag, class_name):
+    def _select(element):
+        return [
+            el for el in element.iter(tag)
+            if class_name in el.get('class', "").split()]
+    return _select
+
+def _compile_selector(path):
+    match = _tag_re.match(path)
+    if match:
+        return _select_tag(match.group(1).lower())
+    match = _tag_class_re.match(path)
+    if match:
+        return _select_tag_class(match.group(1).lower(), match.group(2))
+    # libxml2 finds ids and classes faster with XPath than a scan in
+    # Python would, so these only skip translating the selector
+    match = _id_re.match(path)
+    if match:
+        return lxml.etree.XPath("descendant-or-self::*[@id = '%s']" % match.group(1))
+    match = _class_re.match(path)
+    if match:
+        return lxml.etree.XPath(
+            "descendant-or-self::*[@class and contains("
+            "concat(' ', normalize-space(@class), ' '), ' %s ')]" % match.group(1))
+    return lxml.cssselect.CSSSelector(path, translator='html')
+
+def compiled_selector(path):
+    """A function returning the nodes under an element (or the element
+    itself) that match ``path``, like ``cssselect``.  It is compiled
+    once and kept in ``selector_cache``."""
+    selector = selector_cache.get(path)
+    if selector is None:
+        selector = _compile_selector(path)
+        selector_cache.set(path, selector)
+    return selector
+
+def select(element, path):
+    if _indexes:
+        found = _select_indexed(element, path)
+        if found is not None:
+            return found
+    return compiled_selector(path)(element)
+
+def selector_stats():
+    "Hits, misses and evictions of ``selector_cache``"
+    return selector_cache.stats()
+
+_indexes = weakref.WeakKeyDictionary()
+
+def _document_order(root, el):
+    indexes = []
+    while el is not root:
+        parent = el.getparent()
+        indexes.append(parent.index(el))
+        el = parent
+    indexes.reverse()
+    return indexes
+
+
+class ElementIndex(object):
+    """The elements of a document by id and by class name, built on the
+    first lookup and then kept up to date by the mutators in this
+    module.  Lookups drop entries that have lost their id or class or
+    left the document, but after adding, moving or renaming elements
+    some other way the index should be rebuilt with ``build``."""
+
+    def __init__(self):
+        self.built = False
+        self.entries = collections.defaultdict(list)
+        self.unsorted = set()
+
+    def _keys(self, el):
+        id = el.get('id')
+        if id is not None:
+            yield ('id', id)
+        for class_name in set(el.get('class', "").split()):
+            yield ('class', class_name)
+
+    def build(self, root):
+        self.entries.clear()
+        self.unsorted.clear()
+        for el in root.iter(lxml.etree.Element):
+            for key in self._keys(el):
+                self.entries[key].append(el)
+        self.built = True
+
+    def _nodes(self, el, subtree):
+        if subtree:
+            return el.iter(lxml.etree.Element)
+        return [el]
+
+    def added(self, el, subtree=True):
+        if not self.built:
+            return
+        for node in self._nodes(el, subtree):
+            for key in self._keys(node):
+                self.entries[key].append(node)
+                self.unsorted.add(key)
+
+    def removed(self, el, subtree=True):
+        if not self.built:
+            return
+        for node in self._nodes(el, subtree):
+            for key in self._keys(node):
+                entries = self.entries[key]
+                if node in entries:
+                    entries.remove(node)
+
+    def lookup(self, root, element, key):
+        "The elements under ``element`` with ``key``, eg ('class', 'foo')"
+        if not self.built:
+            self.build(root)
+        entries = self.entries.get(key, [])
+        kind, value = key
+        if kind == 'id':
+            valid = [el for el in entries if el.get('id') == value]
+        else:
+            valid = [el for el in entries if value in el.get('class', "").split()]
+        valid = [el for el in valid if _attached(root, el)]
+        if len(valid) != len(entries):
+            self.entries[key] = list(valid)
+        if key in self.unsorted:
+            valid.sort(key=lambda el: _document_order(root, el))
+            self.entries[key] = list(valid)
+            self.unsorted.discard(key)
+        if element is not root:
+            valid = [el for el in valid if _attached(element, el)]
+        return valid
+
+def enable_index(element):
+    """Keep an ``ElementIndex`` of ``element`` and its descendants, for
+    as long as ``element`` is referenced, and use it to select ``#id``,
+    ``.class`` and ``tag.class`` under it"""
+    element_index = _indexes.get(element)
+    if element_index is None:
+        element_index = _indexes[element] = ElementIndex()
+    return element_index
+
+def _find_indexes(el):
+    if not _indexes:
+        return []
+    found = []
+    for node in itertools.chain([el], el.iterancestors()):
+        element_index = _indexes.get(node)
+        if element_index is not None:
+            found.append((node, element_index))
+    return found
+
+def _select_indexed(element, path):
+    match = _id_re.match(path)
+    if match:
+        key, tag = ('id', match.group(1)), None
+    else:
+        match = _class_re.match(path)
+        if match:
+            key, tag = ('class', match.group(1)), None
+        else:
+            match = _tag_class_re.match(path)
+            if not match:
+                return None
+            key, tag = ('class', match.group(2)), match.group(1).lower()
+    found = _find_indexes(element)
+    if not found:
+        return None
+    root, element_index = found[0]
+    elements = element_index.lookup(root, element, key)
+    if tag is not None:
+        elements = [el for el in elements if el.tag == tag]
+    return elements
+
+def _index_added(el, subtree=True):
+    for (root, element_index) in _find_indexes(el):
+        element_index.added(el, subtree)
+
+def _index_removed(el, subtree=True):
+    for (root, element_index) in _find_indexes(el):
+        element_index.removed(el, subtree)
+
+def select_many(element, paths):
+    "A dict of the nodes matching each of ``paths``, matching each distinct path once"
+    matches = dict()
+    for path in paths:
+        if not path in matches:
+            if path:
+                matches[path] = select(element, path)
+            else:
+                matches[path] = [element]
+    return matches
+
+
 class HtmlElement(lxml.html.HtmlElement):
     def to_string(self, pretty=True, tidy=False):
         if tidy:
@@ -21,98 +229,176 @@ class HtmlElement(lxml.html.HtmlElement):
 
     def add(self, path, text_or_el, index=None):
         if path:
-            elements = self.cssselect(path)
+            elements = select(self, path)
         else:
             elements = [self]
-        if isinstance(text_or_el, (str, unicode)):
-            for el in elements:
-                children = el.getchildren()
-                if children:
-                    last_child = children[-1]
-                    last_child.tail = (last_child.tail or '') + text_or_el
-                else:
-                    el.text = (el.text or '') + text_or_el
-        else:
-            for el in elements:
-                sub_el = copy.deepcopy(text_or_el)
-                if index is None:
-                    el.append(sub_el)
-                else:
-                    el.insert(index, sub_el)
+        add_to(elements, text_or_el, index=index)
 
     def replace(self, path, text_or_el):
-        elements = self.cssselect(path)
-        if isinstance(text_or_el, (str, unicode)):
-            for el in elements:
-                parent = el.getparent()
-                index = parent.index(el)
-                parent.remove(el)
-                if index:
-                    children = parent.getchildren()
-                    prev_child = children[index-1]
-                    prev_child.tail = (prev_child.text or '') + text_or_el
-                else:
-                    parent.text = (parent.text or '') + text_or_el
-        else:
-            for el in elements:
-                sub_el = copy.deepcopy(text_or_el)
-                super(lxml.html.HtmlElement, el.getparent()).replace(el, sub_el)
+        replace_with(select(self, path), text_or_el)
 
     def set_attr(self, path, attr, value):
-        elements = self.cssselect(path)
-        for el in elements:
-            el.attrib[attr] = value
+        set_attr_on(select(self, path), attr, value)
 
     def add_class(self, path, value):
         if path:
-            elements = self.cssselect(path)
+            elements = select(self, path)
         else:
             elements = [self]
-        for el in elements:
-            classes = el.attrib.get('class', '').split()
-            if not value in classes:
-                classes.append(value)
-                el.attrib['class'] = " ".join(classes)
+        add_class_to(elements, value)
 
     def after(self, path, text_or_el):
-        elements = self.cssselect(path)
-        for el in elements:
-            if isinstance(text_or_el, (str, unicode)):
-                el.tail = (el.tail or "") + text_or_el
-            else:
-                parent = el.getparent()
-                index = parent.index(el)
-                parent.insert(index+1, text_or_el)
+        insert_after(select(self, path), text_or_el)
 
     def before(self, path, text_or_el):
-        elements = self.cssselect(path)
+        insert_before(select(self, path), text_or_el)
+
+    def extract(self, path):
+        extract_elements(select(self, path))
+
+    def batch(self, operations):
+        """Apply ``operations``, a list of (path, operation, payload),
+        matching each distinct path only once.  Paths are all matched
+        against the tree as it is before the batch, then the
+        operations are applied in the order given, each to its matches
+        in document order, skipping any an earlier operation removed.
+        Operations are the names of the methods above, with the payload
+        being the ``text_or_el`` they take, a (attr, value) pair for
+        'set_attr', the class for 'add_class' and None for 'extract'."""
+        for (path, operation, payload) in operations:
+            if not operation in _batch_operations:
+                raise ValueError("Unknown operation: %r" % operation)
+        matches = select_many(self, [path for (path, operation, payload) in operations])
+        removed = False
+        for (path, operation, payload) in operations:
+            elements = matches[path]
+            if removed:
+                elements = [el for el in elements if _attached(self, el)]
+            _batch_operations[operation](elements, payload)
+            removed = removed or (operation in ('replace', 'extract'))
+
+    join = wiseguy.utils.join
+
+def add_to(elements, text_or_el, index=None):
+    "Add ``text_or_el`` to each of ``elements``, returning the copies added"
+    added = []
+    if isinstance(text_or_el, (str, unicode)):
         for el in elements:
-            if isinstance(text_or_el, (str, unicode)):
-                previous = el.getprevious()
-                if previous is None:
-                    parent = el.getparent()
-                    parent.text = (parent.text or "") + text_or_el
-                else:
-                    previous.tail = (previous.tail or "") + text_or_el
+            children = el.getchildren()
+            if children:
+                last_child = children[-1]
+                last_child.tail = (last_child.tail or '') + text_or_el
             else:
-                parent = el.getparent()
-                index = parent.index(el)
-                parent.insert(index, text_or_el)
+                el.text = (el.text or '') + text_or_el
+    else:
+        for el in elements:
+            sub_el = copy.deepcopy(text_or_el)
+            if index is None:
+                el.append(sub_el)
+            else:
+                el.insert(index, sub_el)
+            _index_added(sub_el)
+            added.append(sub_el)
+    return added
 
-    def extract(self, path):
-        elements = self.cssselect(path)
+def replace_with(elements, text_or_el):
+    "Replace each of ``elements`` with ``text_or_el``, returning the copies added"
+    added = []
+    if isinstance(text_or_el, (str, unicode)):
         for el in elements:
+            _index_removed(el)
             parent = el.getparent()
             index = parent.index(el)
-            children = el.getchildren()
-            if el.tail:
-                last_child = children[-1]
-                last_child.tail = (last_child.tail or '') + el.tail
-            for sub_el in reversed(children):
-                parent.insert(index, sub_el)
             parent.remove(el)
+            if index:
+                children = parent.getchildren()
+                prev_child = children[index-1]
+                prev_child.tail = (prev_child.tail or '') + text_or_el
+            else:
+                parent.text = (parent.text or '') + text_or_el
+    else:
+        for el in elements:
+            sub_el = copy.deepcopy(text_or_el)
+            _index_removed(el)
+            super(lxml.html.HtmlElement, el.getparent()).replace(el, sub_el)
+            _index_added(sub_el)
+            added.append(sub_el)
+    return added
 
-    join = wiseguy.utils.join
+def set_attr_on(elements, attr, value):
+    indexed = attr in ('id', 'class')
+    for el in elements:
+        if indexed:
+            _index_removed(el, subtree=False)
+        el.attrib[attr] = value
+        if indexed:
+            _index_added(el, subtree=False)
+
+def add_class_to(elements, value):
+    for el in elements:
+        classes = el.attrib.get('class', '').split()
+        if not value in classes:
+            classes.append(value)
+            _index_removed(el, subtree=False)
+            el.attrib['class'] = " ".join(classes)
+            _index_added(el, subtree=False)
+
+def insert_after(elements, text_or_el):
+    for el in elements:
+        if isinstance(text_or_el, (str, unicode)):
+            el.tail = (el.tail or "") + text_or_el
+        else:
+            _index_removed(text_or_el)
+            parent = el.getparent()
+            index = parent.index(el)
+            parent.insert(index+1, text_or_el)
+            _index_added(text_or_el)
+
+def insert_before(elements, text_or_el):
+    for el in elements:
+        if isinstance(text_or_el, (str, unicode)):
+            previous = el.getprevious()
+            if previous is None:
+                parent = el.getparent()
+                parent.text = (parent.text or "") + text_or_el
+            else:
+                previous.tail = (previous.tail or "") + text_or_el
+        else:
+            _index_removed(text_or_el)
+            parent = el.getparent()
+            index = parent.index(el)
+            parent.insert(index, text_or_el)
+            _index_added(text_or_el)
+
+def extract_elements(elements):
+    "Replace each of ``elements`` with its children"
+    for el in elements:
+        _index_removed(el, subtree=False)
+        parent = el.getparent()
+        index = parent.index(el)
+        children = el.getchildren()
+        if el.tail:
+            last_child = children[-1]
+            last_child.tail = (last_child.tail or '') + el.tail
+        for sub_el in reversed(children):
+            parent.insert(index, sub_el)
+        parent.remove(el)
+
+_batch_operations = dict(
+    add=lambda elements, payload: add_to(elements, payload),
+    replace=replace_with,
+    set_attr=lambda elements, payload: set_attr_on(elements, *payload),
+    add_class=add_class_to,
+    after=insert_after,
+    before=insert_before,
+    extract=lambda elements, payload: extract_elements(elements))
+
+def _attached(root, el):
+    while el is not root:
+        el = el.getparent()
+        if el is None:
+            return False
+    return True
 
 class HtmlElementLookup(lxml.html.HtmlElementClassLookup):
     def lookup(self, node_type, document, namespace, name):
@@ -121,11 +407,77 @@ class HtmlElementLookup(lxml.html.HtmlElementClassLookup):
         else:
             return HtmlElement
 
-parser = lxml.html.HTMLParser()
-parser.set_element_class_lookup(HtmlElementLookup())
+_local = threading.local()
+
+def get_parser(encoding=None):
+    """This thread's parser making ``HtmlElement``s, for byte strings in
+    ``encoding`` if given.  lxml parsers can't be used by two threads
+    at once, so each thread gets its own rather than waiting on a
+    shared one."""
+    parsers = _local.__dict__.setdefault('parsers', dict())
+    parser = parsers.get(encoding)
+    if parser is None:
+        parser = parsers[encoding] = lxml.html.HTMLParser(encoding=encoding)
+        parser.set_element_class_lookup(HtmlElementLookup())
+    return parser
+
+
+class ThreadLocalParser(object):
+    "Passes everything on to the parser ``get_parser`` returns for the calling thread"
+
+    def makeelement(self, *args, **kwargs):
+        return get_parser().makeelement(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(get_parser(), name)
+
+parser = ThreadLocalParser()
+
+_fragment_cache = None
+
+def enable_fragment_cache(max_entries=1000, max_bytes=None):
+    """Keep the trees ``Html`` parses in an ``LRUCache`` keyed by their
+    source, and return copies of them when the same source is parsed
+    again.  ``max_bytes`` bounds the total length of the sources kept.
+    Copies aren't inside the html and body elements lxml wraps
+    fragments in, so they have no parent."""
+    global _fragment_cache
+    _fragment_cache = wiseguy.caching.LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+    return _fragment_cache
+
+def disable_fragment_cache():
+    global _fragment_cache
+    _fragment_cache = None
+
+def fragment_cache_stats():
+    "The fragment cache's counters and its ``hit_rate``, or None when it isn't enabled"
+    cache = _fragment_cache
+    if cache is None:
+        return None
+    stats = cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    if lookups:
+        stats['hit_rate'] = float(stats['hits']) / lookups
+    else:
+        stats['hit_rate'] = 0.0
+    return stats
 
-def Html(src):
-    return lxml.html.fromstring(src, parser=parser)
+def Html(src, encoding=None):
+    """Parse ``src`` into an ``HtmlElement``.  If ``src`` is a byte
+    string in a known ``encoding``, eg 'utf-8', it is handed to the
+    parser as it is instead of being decoded first, or having its
+    encoding guessed."""
+    if isinstance(src, unicode):
+        encoding = None
+    cache = _fragment_cache
+    if cache is None:
+        return lxml.html.fromstring(src, parser=get_parser(encoding))
+    key = (src, encoding)
+    element = cache.get(key)
+    if element is None:
+        element = lxml.html.fromstring(src, parser=get_parser(encoding))
+        cache.set(key, element, size=len(src))
+    return element.__copy__()
 
 def add_generator(elem, item):
     for i in item:
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+import cgi, itertools, operator, re, uuid
+
+import lxml.html
+
+import wiseguy.template
+from wiseguy.template import _follow, _index_path
+
+
+def _unicode(value):
+    if value is None:
+        return u""
+    if isinstance(value, basestring):
+        return value
+    return unicode(value)
+
+def _escape(value, quote=False):
+    return cgi.escape(_unicode(value), quote).encode('ascii', 'xmlcharrefreplace')
+
+# libxml2 %-escapes these attributes, picks single quotes for a value
+# with a double quote in it and leaves script and style text as it is.
+# Values it would write differently from ``_escape`` are serialised by
+# libxml2 itself, so that ``render`` gives the same html as ``elements``.
+_URI_ATTRIBUTES = ('href', 'action', 'src')
+_RAW_TEXT = ('script', 'style')
+_PLAIN_URI = re.compile(r"[-\w.~!*'()@/:=?;#%&,+<>]*\Z")
+
+def _plain(value, tag, attr):
+    if attr is None:
+        return tag not in _RAW_TEXT
+    if (attr in _URI_ATTRIBUTES) or ((attr == 'name') and (tag == 'a')):
+        return _PLAIN_URI.match(value) is not None
+    return '"' not in value
+
+def _serialised(value, tag, attr):
+    el = lxml.html.Element(tag)
+    if attr is None:
+        el.text = value
+        html = lxml.html.tostring(el)
+        return html[html.index('>') + 1:html.rindex('</')]
+    el.set(attr, value)
+    html = lxml.html.tostring(el)
+    return html[len("<%s %s=" % (tag, attr)):html.index('>')]
+
+def _writer(tag, attr):
+    "How to write a value as the text or quoted ``attr`` of a ``tag``"
+    def _write(value):
+        value = _unicode(value)
+        if not _plain(value, tag, attr):
+            return _serialised(value, tag, attr)
+        if attr is None:
+            return _escape(value)
+        return '"%s"' % _escape(value, True)
+    return _write
+
+
+class Field(object):
+    "Where a field of each record goes in a row: the text or ``attr`` of the nodes at ``path``"
+    def __init__(self, name, path, attr=None):
+        self.name = name
+        self.path = path
+        self.attr = attr
+
+    def __repr__(self):
+        return "<Field %s %s %s>" % (self.name, self.path, self.attr or "text")
+
+
+def _field(spec):
+    if isinstance(spec, Field):
+        return spec
+    return Field(*spec)
+
+
+class RowTemplateMeta(type):
+    """Compiles ``element`` and ``fields`` once, so that each record is
+    rendered without running any selectors.  Records can be mappings,
+    database rows, named tuples, objects with the field names as
+    attributes, or sequences of values in the order the field names
+    first appear in ``fields``.  Elements are made by
+    copying ``element`` and setting values at fixed child index paths,
+    and html by splicing escaped values between pre-serialised parts."""
+
+    def __init__(cls, cls_name, bases, cls_dict):
+        super(RowTemplateMeta, cls).__init__(cls_name, bases, cls_dict)
+        element = getattr(cls, 'element', None)
+        if element is None:
+            return
+        cls.fields = tuple(_field(spec) for spec in cls.fields)
+        names = []
+        for field in cls.fields:
+            if not field.name in names:
+                names.append(field.name)
+        cls.names = tuple(names)
+        cls.numbers = tuple(names.index(field.name) for field in cls.fields)
+        cls.targets = tuple(
+            tuple(_index_path(element, el) for el in element.cssselect(field.path))
+            for field in cls.fields)
+        cls._compile()
+        cls._getters = dict()
+
+    def _compile(self):
+        marker = "wiseguy-field-%s-" % uuid.uuid4().hex
+        skeleton = self.element.__copy__()
+        skeleton.tail = None
+        slots = []
+        filled = dict()
+        for field, targets, number in zip(self.fields, self.targets, self.numbers):
+            for indexes in targets:
+                if (indexes, field.attr) in filled:
+                    raise ValueError(
+                        "Fields %s and %s both set the %s of %s" % (
+                            filled[indexes, field.attr], field.name,
+                            field.attr or "text", field.path))
+                filled[indexes, field.attr] = field.name
+                el = _follow(skeleton, indexes)
+                token = "%s%d-%d" % (marker, number, len(slots))
+                if field.attr is None:
+                    el.text = token
+                else:
+                    el.attrib[field.attr] = token
+                slots.append((token, number, _writer(el.tag, field.attr), field))
+        html = lxml.html.tostring(skeleton)
+        for token, number, write, field in slots:
+            if token not in html:
+                raise ValueError(
+                    "The %s of %s can't be a field, as it is serialised without its value" % (
+                        field.attr or "text", field.path))
+        self.static = []
+        self.slots = []
+        position = 0
+        for token, number, write, field in sorted(slots, key=lambda slot: html.index(slot[0])):
+            start = html.index(token)
+            end = start + len(token)
+            if field.attr is not None:
+                # The writer quotes attribute values itself
+                start, end = start - 1, end + 1
+            self.static.append(html[position:start])
+            self.slots.append((number, write))
+            position = end
+        self.static.append(html[position:])
+
+    def values(self, record):
+        "The values of ``record`` in the order of ``names``"
+        getter = self._getters.get(type(record))
+        if getter is None:
+            getter = self._getters[type(record)] = self._getter(record)
+        return getter(record)
+
+    def _getter(self, record):
+        names = self.names
+        if isinstance(record, tuple) and hasattr(record, '_fields'):
+            getter = operator.attrgetter(*names)
+        elif isinstance(record, (tuple, list)):
+            return lambda record: record
+        elif hasattr(record, 'keys'):
+            # Dicts and database rows such as sqlalchemy's
+            getter = operator.itemgetter(*names)
+        else:
+            getter = operator.attrgetter(*names)
+        if len(names) == 1:
+            return lambda record: (getter(record),)
+        return getter
+
+    def from_columns(self, columns):
+        "Records from a mapping of field names to sequences of values"
+        return itertools.izip(*[columns[name] for name in self.names])
+
+    def make_element(self, record):
+        el = self.element.__copy__()
+        values = self.values(record)
+        for field, targets, number in zip(self.fields, self.targets, self.numbers):
+            value = _unicode(values[number])
+            for indexes in targets:
+                target = _follow(el, indexes)
+                if field.attr is None:
+                    target.text = value
+                else:
+                    target.attrib[field.attr] = value
+        return el
+
+    def elements(self, records):
+        "An element for each of ``records``"
+        for record in records:
+            yield self.make_element(record)
+
+    def render_row(self, record):
+        static = self.static
+        values = self.values(record)
+        parts = [static[0]]
+        for (number, write), after in zip(self.slots, static[1:]):
+            parts.append(write(values[number]))
+            parts.append(after)
+        return "".join(parts)
+
+    def render_iter(self, records, chunk_size=100):
+        """The html of ``records`` in chunks of up to ``chunk_size`` rows,
+        consuming them as it goes so they can be unbounded"""
+        chunk = []
+        for record in records:
+            chunk.append(self.render_row(record))
+            if len(chunk) >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+
+    def render(self, records):
+        return "".join(self.render_iter(records))
+
+
+class RowTemplate(object):
+    __metaclass__ = RowTemplateMeta
+    fields = ()
+
+
+def add_rows(path, row, content_func, index=None):
+    """Like ``add_multiple``, but ``content_func`` returns records for
+    the ``RowTemplate`` ``row``, and the targets are only selected once"""
+    def _add_rows(template, **kwargs):
+        records = content_func(**kwargs)
+        state = wiseguy.template.anchor_state(template)
+        targets = state.select(path)
+        if not targets:
+            return
+        if len(targets) > 1:
+            records = list(records)
+        for el in targets:
+            position = index
+            for row_el in row.elements(records):
+                if position is None:
+                    el.append(row_el)
+                else:
+                    el.insert(position, row_el)
+                    position = position + 1
+        # Rows only differ from ``row.element`` in their text and the
+        # attributes of their fields
+        state.inserted([row.element])
+        for field in row.fields:
+            if field.attr is not None:
+                state.changed_attribute(field.attr)
+    _add_rows.path = path
+    _add_rows.inserts = True
+    _add_rows.content_func = content_func
+    return _add_rows
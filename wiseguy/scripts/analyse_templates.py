@@ -0,0 +1,19 @@
+#! python
+# -*- coding: utf-8 -*-
+
+import importlib
+import sys
+
+import wiseguy.analysis
+
+
+def main():
+    args = sys.argv[1:]
+    for arg in args:
+        module = importlib.import_module(arg)
+        for report in wiseguy.analysis.analyse_module(module):
+            if report['problems']:
+                print wiseguy.analysis.format_report(report)
+
+if __name__ == '__main__':
+    main()
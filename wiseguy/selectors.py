@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import cssselect
+
+
+class Unsupported(Exception):
+    pass
+
+
+class Compound(object):
+    "A run of simple selectors with no combinator, eg ``a.foo#bar[href]``"
+    def __init__(self, tag=None, id=None, classes=(), attribs=()):
+        self.tag = tag
+        self.id = id
+        self.classes = tuple(classes)
+        self.attribs = tuple(attribs)
+
+    def __repr__(self):
+        return "<Compound %s#%s.%s%s>" % (
+            self.tag or "*", self.id, ".".join(self.classes), list(self.attribs))
+
+    def matches(self, el):
+        if not isinstance(el.tag, basestring):
+            return False
+        if (self.tag is not None) and (el.tag != self.tag):
+            return False
+        attrib = el.attrib
+        if (self.id is not None) and (attrib.get('id') != self.id):
+            return False
+        if self.classes:
+            classes = attrib.get('class', "").split()
+            for class_name in self.classes:
+                if not class_name in classes:
+                    return False
+        for (name, value) in self.attribs:
+            if not name in attrib:
+                return False
+            if (value is not None) and (attrib[name] != value):
+                return False
+        return True
+
+
+def _compound(tree, compound=None):
+    if compound is None:
+        compound = dict(tag=None, id=None, classes=[], attribs=[])
+    kind = type(tree).__name__
+    if kind == 'Element':
+        if tree.namespace:
+            raise Unsupported(tree)
+        if tree.element and (tree.element != "*"):
+            compound['tag'] = tree.element.lower()
+    elif kind == 'Hash':
+        if compound['id'] not in (None, tree.id):
+            raise Unsupported(tree)
+        compound['id'] = tree.id
+        _compound(tree.selector, compound)
+    elif kind == 'Class':
+        compound['classes'].append(tree.class_name)
+        _compound(tree.selector, compound)
+    elif kind == 'Attrib':
+        if tree.namespace:
+            raise Unsupported(tree)
+        if tree.operator == 'exists':
+            value = None
+        elif tree.operator == '=':
+            value = getattr(tree.value, 'value', tree.value)
+        else:
+            raise Unsupported(tree)
+        compound['attribs'].append((tree.attrib.lower(), value))
+        _compound(tree.selector, compound)
+    else:
+        raise Unsupported(tree)
+    return compound
+
+def _chain(tree):
+    if type(tree).__name__ == 'CombinedSelector':
+        if not tree.combinator in (' ', '>'):
+            raise Unsupported(tree)
+        chain = _chain(tree.selector)
+        chain.append((tree.combinator, Compound(**_compound(tree.subselector))))
+        return chain
+    return [(None, Compound(**_compound(tree)))]
+
+def _matches_chain(el, chain, i, root):
+    combinator, compound = chain[i]
+    if not compound.matches(el):
+        return False
+    if i == 0:
+        return True
+    if el is root:
+        return False
+    if combinator == '>':
+        return _matches_chain(el.getparent(), chain, i-1, root)
+    for ancestor in el.iterancestors():
+        if _matches_chain(ancestor, chain, i-1, root):
+            return True
+        if ancestor is root:
+            break
+    return False
+
+
+class Selector(object):
+    """A CSS selector analysed into compounds and combinators.
+
+    A selector is ``simple`` when it is built only from tags, ids,
+    classes, ``[attr]``/``[attr=value]`` tests and the descendant and
+    child combinators.  Whether a node matches a simple selector
+    depends only on that node and its ancestors, which is what lets
+    templates reason about which nodes a mutation can affect.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.chains = []
+        self.simple = True
+        for parsed in cssselect.parse(path):
+            try:
+                if parsed.pseudo_element:
+                    raise Unsupported(parsed.pseudo_element)
+                self.chains.append(_chain(parsed.parsed_tree))
+            except Unsupported:
+                self.simple = False
+                self.chains = []
+                break
+        self.attributes = set()
+        for chain in self.chains:
+            for (combinator, compound) in chain:
+                if compound.id is not None:
+                    self.attributes.add('id')
+                if compound.classes:
+                    self.attributes.add('class')
+                for (name, value) in compound.attribs:
+                    self.attributes.add(name)
+
+    def __repr__(self):
+        return "<Selector %r>" % self.path
+
+    def subject_matches(self, el):
+        "Could ``el`` match, ignoring its ancestors?"
+        for chain in self.chains:
+            if chain[-1][1].matches(el):
+                return True
+        return False
+
+    def matches(self, el, root):
+        "Does ``el`` match, when selecting from ``root``?"
+        for chain in self.chains:
+            if _matches_chain(el, chain, len(chain)-1, root):
+                return True
+        return False
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
 
-import collections, copy, functools, contextlib
+import cgi, collections, copy, functools, contextlib, itertools, sys, timeit, types
+import multiprocessing, multiprocessing.pool, threading, Queue
 
-import lxml.html
+import lxml.etree, lxml.html
+import cssselect
+
+import wiseguy.caching
+import wiseguy.html
+import wiseguy.selectors
+import wiseguy.tracing
 
 
 class Transform(object):
@@ -34,58 +41,1126 @@ class Transform(object):
         return Transform(new_keys, self.action, new_context)
 
 
+def _index_path(root, el):
+    indexes = []
+    while el is not root:
+        parent = el.getparent()
+        indexes.append(parent.index(el))
+        el = parent
+    indexes.reverse()
+    return tuple(indexes)
+
+def _follow(root, indexes):
+    el = root
+    for index in indexes:
+        el = el[index]
+    return el
+
+def _simple_selector(path):
+    if not path:
+        return None
+    try:
+        selector = wiseguy.selectors.Selector(path)
+    except cssselect.SelectorError:
+        return None
+    if not selector.simple:
+        return None
+    return selector
+
+def _transform_paths(transforms):
+    for transform in transforms:
+        path = getattr(transform.action, 'path', None)
+        if path:
+            yield path
+
+
+class Anchors(object):
+    """The nodes each transform path matches in a pristine element,
+    stored as paths of child indexes so they can be found again in a
+    copy of that element without running the selector."""
+
+    def __init__(self, element, paths):
+        self.selectors = dict()
+        self.positions = dict()
+        if element is None:
+            return
+        for path in paths:
+            if path in self.selectors:
+                continue
+            selector = _simple_selector(path)
+            if selector is None:
+                continue
+            self.selectors[path] = selector
+            self.positions[path] = [
+                _index_path(element, el) for el in element.cssselect(path)]
+
+    def bind(self, element):
+        return AnchorState(self, element)
+
+    def plan(self, element, transforms):
+        "The ``SerializationPlan`` for ``element``, or None if there can't be one"
+        if not hasattr(self, '_plan'):
+            self._plan = None
+            regions = self._regions(transforms)
+            if regions is not None:
+                self._plan = SerializationPlan(element, regions, self.positions)
+                self._plan.streams = self._streams(transforms)
+        return self._plan
+
+    def restrict(self, indexes):
+        """Anchors for a copy of the node at ``indexes`` under a spine of
+        copies of its ancestors, each an only child.  Only the positions
+        within that node and on its spine are kept."""
+        anchors = Anchors(None, ())
+        depth = len(indexes)
+        for path, positions in self.positions.iteritems():
+            anchors.selectors[path] = self.selectors[path]
+            anchors.positions[path] = [
+                ((0,) * min(depth, len(position))) + position[depth:]
+                for position in positions
+                if position[:depth] == indexes[:len(position)]]
+        return anchors
+
+    def _streams(self, transforms):
+        # A region's own node can only come to match a replace path if
+        # a set_attr changes an attribute that path tests.  Replacing it
+        # with text would then change the static parts around it
+        attributes = set(
+            getattr(transform.action, 'attribute', None) for transform in transforms)
+        for transform in transforms:
+            action = transform.action
+            if getattr(action, 'replaces', False):
+                if self.selectors[action.path].attributes & attributes:
+                    return False
+        return True
+
+    def _regions(self, transforms):
+        nodes = set()
+        for transform in transforms:
+            action = transform.action
+            path = getattr(action, 'path', None)
+            if not path in self.selectors:
+                return None
+            for indexes in self.positions[path]:
+                if getattr(action, 'replaces', False):
+                    # Replacing can change how the siblings are serialised
+                    if not indexes:
+                        return None
+                    indexes = indexes[:-1]
+                nodes.add(indexes)
+        regions = []
+        for indexes in sorted(nodes):
+            if regions and (indexes[:len(regions[-1])] == regions[-1]):
+                continue
+            regions.append(indexes)
+        if () in regions:
+            return None
+        return regions
+
+
+class AnchorState(object):
+    """Anchors bound to one element, along with a record of how that
+    element has been changed since it was copied.
+
+    Selectors are only analysed into ``simple`` ones, which depend on a
+    node and its ancestors alone.  So an anchored path stays valid
+    until either an inserted subtree contains a node that could match
+    it, or an attribute it tests is changed.  Inserting anything moves
+    the nodes after it though, so the state is no longer ``clean`` and
+    its positions can't be reused for new copies.  Anything else that
+    touches the element (any action that isn't one of the helpers
+    below) taints the state and every lookup falls back to cssselect.
+    """
+
+    def __init__(self, anchors, element):
+        self.anchors = anchors
+        self.element = element
+        self.nodes = None
+        self.invalid = set()
+        self.attributes = set()
+        self.removed = False
+        self.grown = False
+        self.tainted = False
+        self.selected = 0
+
+    @property
+    def clean(self):
+        return not (
+            self.tainted or self.invalid or self.attributes or self.removed or self.grown)
+
+    def _resolve(self):
+        self.nodes = dict()
+        for path, positions in self.anchors.positions.iteritems():
+            self.nodes[path] = [
+                _follow(self.element, indexes) for indexes in positions]
+
+    def _attached(self, el):
+        for ancestor in el.iterancestors():
+            if ancestor is self.element:
+                return True
+        return el is self.element
+
+    def select(self, path):
+        nodes = self._select(path)
+        self.selected = self.selected + len(nodes)
+        return nodes
+
+    def anchored(self, path):
+        "Would selecting ``path`` use its anchors, rather than cssselect?"
+        if self.tainted or ((self.nodes is None) and not self.clean):
+            return False
+        selector = self.anchors.selectors.get(path)
+        if (selector is None) or (path in self.invalid):
+            return False
+        return not (selector.attributes & self.attributes)
+
+    def _select(self, path):
+        if not path:
+            return [self.element]
+        if self.nodes is None:
+            if self.clean:
+                self._resolve()
+            else:
+                self.tainted = True
+        if not self.anchored(path):
+            return wiseguy.html.select(self.element, path)
+        nodes = self.nodes[path]
+        if self.removed:
+            nodes = [el for el in nodes if self._attached(el)]
+        return nodes
+
+    def inserted(self, elements):
+        if elements:
+            self.grown = True
+        selectors = [
+            (path, selector)
+            for (path, selector) in self.anchors.selectors.iteritems()
+            if not path in self.invalid]
+        for element in elements:
+            for el in element.iter():
+                for (path, selector) in selectors:
+                    if selector.subject_matches(el):
+                        self.invalid.add(path)
+                selectors = [s for s in selectors if not s[0] in self.invalid]
+
+    def removed_elements(self):
+        self.removed = True
+
+    def changed_attribute(self, attr):
+        self.attributes.add(attr.lower())
+
+    def taint(self):
+        self.tainted = True
+
+class SerializationPlan(object):
+    """The serialised form of an element, split around the regions
+    that transforms can change.  Serialising a copy of the element only
+    has to serialise those regions, splicing them between the static
+    parts, and gives the same result as ``lxml.html.tostring`` with
+    ``pretty_print``."""
+
+    marker = 'wiseguy-region'
+    streams = False
+
+    def __init__(self, element, regions, positions=None):
+        self.regions = regions
+        self.first = _first_regions(regions, positions or dict())
+        skeleton = clone_element(element)
+        tags = []
+        for number, indexes in enumerate(regions):
+            el = _follow(skeleton, indexes)
+            placeholder = el.makeelement(el.tag, {self.marker: str(number)})
+            placeholder.tail = el.tail
+            parent = el.getparent()
+            parent[parent.index(el)] = placeholder
+            tags.append(el.tag)
+        text = lxml.html.tostring(skeleton, pretty_print=True)
+        self.static = []
+        position = 0
+        for number, tag in enumerate(tags):
+            start_tag = '<%s %s="%s">' % (tag, self.marker, number)
+            start = text.index(start_tag, position)
+            end = start + len(start_tag)
+            end_tag = '</%s>' % tag
+            if text.startswith(end_tag, end):
+                end = end + len(end_tag)
+            self.static.append(text[position:start])
+            position = end
+        self.static.append(text[position:])
+
+    def share(self, positions, streams):
+        """A plan sharing these regions and static parts, for transforms
+        anchored at ``positions``"""
+        plan = copy.copy(self)
+        plan.first = _first_regions(self.regions, positions)
+        plan.streams = streams
+        return plan
+
+    def resolve(self, element):
+        "The regions in a copy of the planned element, before it is changed"
+        return [_follow(element, indexes) for indexes in self.regions]
+
+    def intact(self, nodes):
+        "Are the regions still where they were planned to be?"
+        for node in nodes:
+            if node.getparent() is None:
+                return False
+        return True
+
+    def fragment(self, node):
+        fragment = lxml.html.tostring(node, pretty_print=True, with_tail=False)
+        # lxml ends a pretty printed fragment with a newline, whereas
+        # any newline after the region is already in the static part
+        if fragment.endswith("\n"):
+            fragment = fragment[:-1]
+        return fragment
+
+    def serialize(self, nodes):
+        parts = [self.static[0]]
+        for node, static in zip(nodes, self.static[1:]):
+            parts.append(self.fragment(node))
+            parts.append(static)
+        return "".join(parts)
+
+    def settled(self, state, nodes, pending, start=0):
+        """How many of the leading regions none of the ``pending``
+        transforms can change any more.  Paths that are still anchored
+        can only reach the regions they were planned for, and ones that
+        have fallen back to cssselect reach the regions they match now,
+        as nothing can make a node in a settled region match later."""
+        if state.tainted:
+            return start
+        bound = len(nodes)
+        fallbacks = []
+        for transform in pending:
+            path = getattr(transform.action, 'path', None)
+            if not path in self.first:
+                return start
+            selector = state.anchors.selectors[path]
+            if (path in state.invalid) or (selector.attributes & state.attributes):
+                fallbacks.append(path)
+            else:
+                bound = min(bound, self.first[path])
+        if (bound <= start) or not fallbacks:
+            return bound
+        numbers = dict((node, number) for (number, node) in enumerate(nodes))
+        for path in fallbacks:
+            for el in wiseguy.html.select(state.element, path):
+                for ancestor in itertools.chain([el], el.iterancestors()):
+                    if ancestor in numbers:
+                        bound = min(bound, numbers[ancestor])
+                        break
+                else:
+                    return start
+            if bound <= start:
+                break
+        return bound
+
+def _first_regions(regions, positions):
+    first = dict()
+    for path, path_positions in positions.iteritems():
+        first[path] = min([
+            number for (number, indexes) in enumerate(regions)
+            for position in path_positions
+            if position[:len(indexes)] == indexes] or [len(regions)])
+    return first
+
+def anchor_state(template):
+    "The anchors of ``template``, or empty ones if it has none"
+    state = getattr(template, 'anchors', None)
+    if state is None:
+        state = Anchors(None, ()).bind(template.element)
+    return state
+
+
+def _merge_transforms(transforms, new_transforms):
+    # Paths select across the whole element, so applying the same
+    # transform a second time can only repeat what the first did
+    merged = list(transforms)
+    contexts = collections.defaultdict(list)
+    for transform in transforms:
+        contexts[(transform.action, transform.keys)].append(transform.context)
+    for transform in new_transforms:
+        seen = contexts[(transform.action, transform.keys)]
+        if not transform.context in seen:
+            seen.append(transform.context)
+            merged.append(transform)
+    return tuple(merged)
+
+def clone_element(element):
+    "A copy of ``element`` and its subtree, made natively by lxml"
+    return element.__copy__()
+
+_frozen_types = (basestring, int, long, float, bool, types.NoneType)
+
+def _freeze(value):
+    # Only values that compare by what they contain make keys.  Other
+    # objects hash by identity, so a changed one would still hit and a
+    # new one for each request would always miss.  Each is tagged with
+    # its type, as values that compare equal, such as 1, True and 1.0
+    # or a string and the element it parses to, can render differently
+    if isinstance(value, _frozen_types):
+        return (type(value).__name__, value)
+    if isinstance(value, lxml.etree._Element):
+        return ('element', lxml.etree.tostring(value))
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted(
+            (_freeze(k), _freeze(v)) for (k, v) in value.iteritems())))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(_freeze(v) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return ('set', frozenset(_freeze(v) for v in value))
+    raise TypeError("Can't make a cache key from %r" % type(value))
+
+
+class _Baking(object):
+    def __init__(self, element):
+        self.element = element
+
+def _related(nodes, others):
+    "Is any of ``nodes`` the same as, or an ancestor or descendant of, any of ``others``?"
+    for (first, second) in ((nodes, others), (others, nodes)):
+        second = set(second)
+        for el in first:
+            if el in second:
+                return True
+            for ancestor in el.iterancestors():
+                if ancestor in second:
+                    return True
+    return False
+
+def _bake(baking, transform, pending):
+    """Apply the key-less ``transform`` to ``baking.element``, unless
+    that could give a different result to applying it after the
+    ``pending`` transforms that precede it.  Returns whether it did."""
+    action = transform.action
+    if not pending:
+        action(template=baking, **transform.context)
+        return True
+    # What a pending transform inserts isn't known until it renders,
+    # and could be matched by ``transform``
+    for other in pending:
+        if getattr(other.action, 'inserts', False):
+            return False
+    element = baking.element
+    selector = _simple_selector(getattr(action, 'path', None))
+    if selector is None:
+        return False
+    targets = element.cssselect(action.path)
+    if getattr(action, 'replaces', False):
+        # Text put in place of a node goes on the tail of the one before
+        targets = targets + [
+            el.getprevious() for el in targets if el.getprevious() is not None]
+    matches = []
+    for other in pending:
+        other_path = getattr(other.action, 'path', None)
+        if _simple_selector(other_path) is None:
+            return False
+        if getattr(other.action, 'attribute', None) in selector.attributes:
+            return False
+        matched = element.cssselect(other_path)
+        if _related(targets, matched):
+            return False
+        matches.append((other_path, matched))
+    backup = clone_element(element)
+    action(template=baking, **transform.context)
+    for (other_path, matched) in matches:
+        now = element.cssselect(other_path)
+        if (len(now) != len(matched)) or [a for (a, b) in zip(now, matched) if a is not b]:
+            baking.element = backup
+            return False
+    return True
+
+
 class TemplateMeta(type):
-    applied_transforms = []
+    baked_transforms = ()
 
-    def keys(self):
-        keys = set()
+    def __init__(cls, cls_name, bases, cls_dict):
+        super(TemplateMeta, cls).__init__(cls_name, bases, cls_dict)
+        transforms = getattr(cls, 'transforms', None)
+        if transforms is not None:
+            cls.transforms = tuple(transforms)
+        cls.reanchor(cls_dict.get('anchors'))
+
+    def bake(self):
+        """The template renders are made from: this one with the
+        transforms that wait on no keys folded into a copy of its
+        element, instead of applied on every render, and recorded in
+        ``baked_transforms``.  One that follows keyed transforms is only
+        baked if it can't interact with them.  This template keeps all
+        its transforms, as they may be meant for the page it is
+        extended into or added to as a widget."""
+        cached = self.__dict__.get('_baked')
+        if (cached is None) or (cached[0] is not self.transforms):
+            cached = (self.transforms, self._bake())
+            self._baked = cached
+        return cached[1]
+
+    def _bake(self):
+        if (getattr(self, 'element', None) is None) or (getattr(self, 'transforms', None) is None):
+            return self
+        index, static = self.key_index()
+        if not static:
+            return self
+        baking = _Baking(clone_element(self.element))
+        pending = []
+        baked = []
         for transform in self.transforms:
-            keys = keys | transform.keys
-        return keys
+            if transform.keys or _is_deferred(transform) or not _bake(baking, transform, pending):
+                pending.append(transform)
+            else:
+                baked.append(transform)
+        if not baked:
+            return self
+        return TemplateMeta(
+            self.__name__,
+            (Template,),
+            dict(
+                element=baking.element,
+                transforms=tuple(pending),
+                baked_transforms=self.baked_transforms + tuple(baked)))
+
+    def reanchor(self, anchors=None):
+        """Resolve transform paths again, eg after changing ``element`` by
+        hand.  Without ``anchors`` they are resolved when first needed, so
+        templates that are only ever extended never resolve them."""
+        self._baked = None
+        if isinstance(anchors, Anchors):
+            self._anchor_state = anchors.bind(self.element)
+        else:
+            self._anchor_state = None
+
+    @property
+    def anchors(self):
+        state = self.__dict__.get('_anchor_state')
+        if state is None:
+            element = getattr(self, 'element', None)
+            if element is None:
+                return None
+            state = Anchors(element, _transform_paths(self.transforms)).bind(element)
+            self._anchor_state = state
+        return state
+
+    def pristine_anchors(self):
+        "Anchors that are still valid for a copy of this template's element"
+        if self.anchors is not None and self.anchors.clean:
+            return self.anchors.anchors
+        return None
+
+    def serialization_plan(self):
+        "How to serialise renders by splicing pre-serialised static parts, if possible"
+        anchors = self.pristine_anchors()
+        if anchors is None:
+            return None
+        return anchors.plan(self.element, self.transforms)
+
+    def key_index(self):
+        """The positions in ``transforms`` of the transforms waiting on
+        each key, and of those waiting on none"""
+        cached = self.__dict__.get('_key_index')
+        if (cached is None) or (cached[0] is not self.transforms):
+            index = collections.defaultdict(list)
+            static = []
+            for position, transform in enumerate(self.transforms):
+                if not transform.keys:
+                    static.append(position)
+                for key in transform.keys:
+                    index[key].append(position)
+            cached = (self.transforms, dict(index), static)
+            self._key_index = cached
+        return cached[1], cached[2]
+
+    def keys(self):
+        index, static = self.key_index()
+        return set(index)
 
     def apply(self, context):
-        for transform in list(self.transforms):
-            new_transform = transform.apply(context)
-            self.transforms.remove(transform)
-            if new_transform.applied:
-                new_transform.action(template=self, **new_transform.context)
-                self.applied_transforms.append(new_transform)
+        for applied in self._applying(context):
+            pass
+
+    def shape_plan(self, context):
+        """The steps for applying a context with the same keys as
+        ``context``, and the transforms among them that will fire.  Each
+        step is a position in ``transforms``, the transform there and
+        whether the context completes it.  Plans are cached by which of
+        the template's keys the context has, and shared with copies."""
+        index, static = self.key_index()
+        if len(context) < len(index):
+            shape = frozenset(key for key in context if key in index)
+        else:
+            shape = frozenset(key for key in index if key in context)
+        cached = self._shape_plan_cache()
+        plan = cached[1].get(shape)
+        if plan is None:
+            positions = set(static)
+            for key in shape:
+                positions.update(index[key])
+            steps = tuple(
+                (position, self.transforms[position], self.transforms[position].keys <= shape)
+                for position in sorted(positions))
+            plan = (steps, tuple(transform for (position, transform, fires) in steps if fires))
+            cached[1].set(shape, plan)
+        return plan
+
+    def _shape_plan_cache(self):
+        cached = self.__dict__.get('_shape_plans')
+        if (cached is None) or (cached[0] is not self.transforms):
+            cached = (self.transforms, wiseguy.caching.LRUCache(max_entries=64))
+            self._shape_plans = cached
+        return cached
+
+    def _applying(self, context):
+        """Apply the transforms ``context`` completes one at a time,
+        yielding after each how many have been applied"""
+        cache = self.__dict__.get('cache')
+        if cache is not None:
+            cache.clear()
+        transforms = self.transforms
+        steps, fired = self.shape_plan(context)
+        if not steps:
+            return
+        recorders = wiseguy.tracing.recorders()
+        remaining = list(transforms)
+        applied = 0
+        for position, transform, fires in steps:
+            if not fires:
+                remaining[position] = transform.apply(context)
+                continue
+            remaining[position] = None
+            kwargs = dict(transform.context)
+            for key in transform.keys:
+                kwargs[key] = context[key]
+            if not hasattr(transform.action, 'path'):
+                anchor_state(self).taint()
+            if recorders:
+                self._apply_traced(transform.action, kwargs, recorders)
             else:
-                self.transforms.append(new_transform)
+                transform.action(template=self, **kwargs)
+            applied = applied + 1
+            yield applied
+        # Keep any transforms that actions added, eg with ``add_widget``
+        self.transforms = tuple(
+            [t for t in remaining if t is not None]) + self.transforms[len(transforms):]
+
+    def _apply_traced(self, action, kwargs, recorders):
+        path = getattr(action, 'path', None)
+        state = self.anchors
+        if state is not None:
+            selected = state.selected
+        start = timeit.default_timer()
+        action(template=self, **kwargs)
+        seconds = timeit.default_timer() - start
+        if path and (state is not None):
+            matches = state.selected - selected
+        else:
+            matches = None
+        keys = sorted(kwargs)
+        for recorder in recorders:
+            recorder.record(self.__name__, keys, path, matches, seconds)
 
     def copy(self):
+        # Transforms are never changed in place, so the tuple can be
+        # shared rather than copied, along with the key index and the
+        # shape plans, which are built here so every copy uses them
+        self.key_index()
         return TemplateMeta(
-            'Template',
+            self.__name__,
             (Template,),
             dict(
-                element=copy.deepcopy(self.element),
-                transforms=copy.deepcopy(self.transforms)))
+                element=clone_element(self.element),
+                transforms=self.transforms,
+                anchors=self.pristine_anchors(),
+                baked_transforms=self.baked_transforms,
+                _key_index=self._key_index,
+                _shape_plans=self._shape_plan_cache()))
 
-    def extend(self, template):
-        self.transforms.extend(template.transforms)
-        self.apply(template(dict()))
+    def extend(self, *templates):
+        """Merge each of ``templates`` into this one in turn, applying
+        what they provide and keeping the transforms still waiting.
+        Transforms already present aren't added again, and key-less ones
+        are applied straight away and recorded as baked."""
+        for template in templates:
+            self.transforms = _merge_transforms(self.transforms, template.transforms)
+            static = tuple(t for t in self.transforms if not t.keys)
+            self.apply(template(dict()))
+            self.baked_transforms = self.baked_transforms + static
+        self.reanchor()
 
     def add_widget(self, path, template):
         self.element.add(path, template.element)
-        self.transforms.extend(template.transforms)
+        self.transforms = self.transforms + tuple(template.transforms)
+        self.reanchor()
+
+    def cache_key(self, context):
+        """A hashable key for the values in ``context`` that this
+        template consumes, or None if any isn't a plain value: a string,
+        number, None or element, or a list, tuple, set or dict of them"""
+        keys = self.keys()
+        try:
+            return tuple(
+                (key, _freeze(context[key])) for key in sorted(keys) if key in context)
+        except TypeError:
+            return None
+
+    def _cache(self, kind, context):
+        # Setting ``cache`` (eg a ``wiseguy.caching.LRUCache``) on a
+        # template declares that its transforms are pure functions of
+        # the context.  Only a cache set on the template itself applies,
+        # so neither subclasses nor render copies can share it
+        cache = self.__dict__.get('cache')
+        if cache is None:
+            return None, None
+        key = self.cache_key(context)
+        if key is None:
+            return None, None
+        return cache, (kind, key)
 
     def render_lxml(self, kwargs):
-        template = self.copy()
+        cache, key = self._cache('lxml', kwargs)
+        if cache is not None:
+            element = cache.get(key)
+            if element is not None:
+                return clone_element(element)
+        template = self.bake().copy()
         template.apply(kwargs)
+        if cache is not None:
+            # Only a cache bounded by size needs the size of the html
+            size = None
+            if getattr(cache, 'max_bytes', None) is not None:
+                size = len(lxml.html.tostring(template.element))
+            cache.set(key, clone_element(template.element), size=size)
         return template.element
 
     def render(self, **kwargs):
-        html = self.render_lxml(kwargs)
-        return lxml.html.tostring(html, pretty_print=True)
+        cache, key = self._cache('html', kwargs)
+        if cache is not None:
+            html = cache.get(key)
+            if html is None:
+                html = self._render(kwargs)
+                cache.set(key, html)
+            return html
+        return self._render(kwargs)
+
+    def _render(self, kwargs):
+        source = self.bake()
+        plan = source.serialization_plan()
+        template = source.copy()
+        if plan is not None:
+            regions = plan.resolve(template.element)
+        template.apply(kwargs)
+        if (plan is None) or template.anchors.tainted or not plan.intact(regions):
+            return lxml.html.tostring(template.element, pretty_print=True)
+        return plan.serialize(regions)
+
+    def render_iter(self, **kwargs):
+        """Render the template as chunks of html in document order, which
+        join to give the same as ``render``.  The part before the first
+        region transforms can change is yielded before any are applied,
+        and each region as soon as nothing left to apply can change it."""
+        source = self.bake()
+        plan = source.serialization_plan()
+        if (plan is None) or (not plan.streams) or (self.__dict__.get('cache') is not None):
+            yield self.render(**kwargs)
+            return
+        template = source.copy()
+        regions = plan.resolve(template.element)
+        sent = [plan.static[0]]
+        yield plan.static[0]
+        flushed = 0
+        steps, fired = template.shape_plan(kwargs)
+        for applied in template._applying(kwargs):
+            settled = plan.settled(template.anchors, regions, fired[applied:], flushed)
+            while flushed < settled:
+                chunk = plan.fragment(regions[flushed]) + plan.static[flushed+1]
+                sent.append(chunk)
+                yield chunk
+                flushed = flushed + 1
+        if template.anchors.tainted or not plan.intact(regions[flushed:]):
+            html = lxml.html.tostring(template.element, pretty_print=True)
+            prefix = "".join(sent)
+            assert html.startswith(prefix)
+            yield html[len(prefix):]
+            return
+        while flushed < len(regions):
+            yield plan.fragment(regions[flushed]) + plan.static[flushed+1]
+            flushed = flushed + 1
+
+    def deferred_shell(self):
+        """The template with each deferred transform swapped for one that
+        leaves placeholders where its content will go, along with the
+        deferred transforms in the order they are numbered"""
+        cached = self.__dict__.get('_deferred_shell')
+        if (cached is None) or (cached[0] is not self.transforms):
+            deferred = []
+            transforms = []
+            for transform in self.transforms:
+                if _is_deferred(transform):
+                    transforms.append(Transform(
+                        transform.keys,
+                        _placeholder(transform.action, len(deferred)),
+                        transform.context))
+                    deferred.append(transform)
+                else:
+                    transforms.append(transform)
+            if deferred:
+                shell = TemplateMeta(
+                    self.__name__,
+                    (Template,),
+                    dict(element=self.element, transforms=transforms))
+            else:
+                shell = self
+            cached = (self.transforms, shell, tuple(deferred))
+            self._deferred_shell = cached
+        return cached[1], cached[2]
+
+    def render_deferred(self, kwargs, pool=None):
+        """Like ``render_iter`` with the context ``kwargs``, but the
+        content of deferred transforms is evaluated on ``pool`` while
+        the rest of the page streams with placeholders in its place.
+        Each is then sent as it is ready, as a fragment and a script
+        that swaps it in, before ``</body>``, with whatever the later
+        transforms would have done to it.  The context is a dict rather
+        than keyword arguments so that any key can be used."""
+        shell, deferred = self.deferred_shell()
+        if pool is None:
+            pool = value_pool()
+        results = Queue.Queue()
+        positions = [position for position, transform in enumerate(self.transforms)
+                     if _is_deferred(transform)]
+        actions = dict()
+        for number, transform in enumerate(deferred):
+            if not all(key in kwargs for key in transform.keys):
+                continue
+            new_transform = transform.apply(kwargs)
+            actions[number] = new_transform.action
+            pool.apply_async(
+                _evaluate_deferred,
+                (number, new_transform.action, new_transform.context, results))
+        previous = None
+        for chunk in shell.render_iter(**kwargs):
+            if previous is not None:
+                yield previous
+            previous = chunk
+        if previous is None:
+            previous = ""
+        end = previous.rfind("</body>")
+        if end == -1:
+            end = len(previous)
+        yield previous[:end]
+        values = dict()
+        waiting = set(actions)
+        while waiting:
+            number, value, error = results.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            values[number] = value
+            for number in sorted(waiting):
+                if number not in values:
+                    continue
+                fragments = _deferred_fragments(
+                    shell, positions, number, actions, values, kwargs)
+                if fragments is not None:
+                    waiting.remove(number)
+                    yield fragments
+        yield previous[end:]
+
+    def fragment(self, path):
+        """A template for just the first node matching ``path``, along
+        with the path of child indexes to that node in its element, or
+        None if there is no such node or the transforms can't be
+        restricted to it.  The node is
+        copied under a spine of copies of its ancestors, so that paths
+        match inside it as they do in the whole element.  Only the
+        transforms anchored inside it, and the set_attr and replace
+        transforms anchored on its spine, are kept as they are.  The
+        rest only run if a change means their path has to be matched
+        again with cssselect."""
+        cached = self.__dict__.get('_fragments')
+        if (cached is None) or (cached[0] is not self.transforms):
+            cached = (self.transforms, dict())
+            self._fragments = cached
+        if not path in cached[1]:
+            cached[1][path] = self._fragment(path)
+        return cached[1][path]
+
+    def _fragment(self, path):
+        anchors = self.pristine_anchors()
+        if anchors is None:
+            return None
+        for transform in self.transforms:
+            if not getattr(transform.action, 'path', None) in anchors.selectors:
+                return None
+        nodes = self.element.cssselect(path)
+        if not nodes:
+            return None
+        node = nodes[0]
+        indexes = _index_path(self.element, node)
+        element = clone_element(node)
+        element.tail = None
+        # Only up to the template's element, not the html and body
+        # elements lxml wraps parsed fragments in
+        for ancestor in itertools.islice(node.iterancestors(), len(indexes)):
+            spine = ancestor.makeelement(ancestor.tag, ancestor.attrib)
+            spine.append(element)
+            element = spine
+        restricted = anchors.restrict(indexes)
+        transforms = []
+        for transform in self.transforms:
+            action = transform.action
+            positions = restricted.positions[action.path]
+            inside = [p for p in positions if len(p) >= len(indexes)]
+            affects_spine = (
+                hasattr(action, 'attribute') or getattr(action, 'replaces', False))
+            if inside or (positions and affects_spine):
+                transforms.append(transform)
+            else:
+                transforms.append(
+                    Transform(transform.keys, _when_reselected(action), transform.context))
+        template = TemplateMeta(
+            self.__name__,
+            (Template,),
+            dict(
+                element=element,
+                transforms=transforms,
+                anchors=restricted,
+                baked_transforms=self.baked_transforms))
+        return template, (0,) * len(indexes)
+
+    def render_fragment(self, path, kwargs):
+        """The html of the first node matching ``path`` in the template,
+        once rendered with the context ``kwargs``, copying and
+        transforming only that node where possible.  It is empty if
+        there is no such node, or if the render removes it."""
+        # Baking could change which node ``path`` matches first, so this
+        # works on the template as it is.  Baked transforms outside the
+        # node don't run anyway
+        fragment = self.fragment(path)
+        if fragment is not None:
+            html = _render_node(fragment[0], fragment[1], kwargs)
+            if html is not None:
+                return html
+        nodes = self.element.cssselect(path)
+        if not nodes:
+            return ""
+        return _render_node(self, _index_path(self.element, nodes[0]), kwargs) or ""
+
+    def render_many(self, contexts, workers=None, chunk_size=1, pool='process', ordered=True):
+        """Render the template with each of ``contexts``, yielding the
+        results as they are ready.  ``pool`` is 'process', 'thread' or
+        None to render serially in this thread."""
+        if pool is None:
+            return (self.render(**context) for context in contexts)
+        if not pool in ('process', 'thread'):
+            raise ValueError("Unknown pool: %r" % pool)
+        return _render_pooled(self, contexts, workers, chunk_size, pool, ordered)
 
     def __call__(self, kwargs):
         return self.render_lxml(kwargs)
 
 
+_worker_template = None
+
+def _init_worker(template):
+    # Pool workers are forked, so the template doesn't have to be
+    # picklable, only the contexts and results
+    global _worker_template
+    _worker_template = template
+
+def _render_in_worker(context):
+    return _worker_template.render(**context)
+
+def _render_context(template, context):
+    return template.render(**context)
+
+def _render_pooled(template, contexts, workers, chunk_size, kind, ordered):
+    if kind == 'process':
+        pool = multiprocessing.Pool(workers, _init_worker, (template,))
+        func = _render_in_worker
+    else:
+        pool = multiprocessing.pool.ThreadPool(workers)
+        func = functools.partial(_render_context, template)
+    try:
+        if ordered:
+            results = pool.imap(func, contexts, chunk_size)
+        else:
+            results = pool.imap_unordered(func, contexts, chunk_size)
+        for html in results:
+            yield html
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 class Template(object):
     __metaclass__ = TemplateMeta
 
 
+# Swaps the fragment ``n`` in for its placeholder, or for all of them
+# when there is one fragment for every place the content went
+_SWAP_SCRIPT = (
+    '(function(n){var f=document.getElementById("wiseguy-deferred-"+n),'
+    'p=document.querySelectorAll("[data-wiseguy-deferred]"),i,v;'
+    'for(i=0;i<p.length;i++){v=p[i].getAttribute("data-wiseguy-deferred");'
+    'if(v==n||v.split(".")[0]==n)'
+    '{p[i].parentNode.replaceChild(document.importNode(f.content,true),p[i]);}}'
+    'f.parentNode.removeChild(f);})("%s")')
+
+def _is_deferred(transform):
+    return getattr(transform.action, 'deferred', False)
+
+def _render_node(template, indexes, kwargs):
+    template = template.copy()
+    node = _follow(template.element, indexes)
+    template.apply(kwargs)
+    if not wiseguy.html._attached(template.element, node):
+        return None
+    return lxml.html.tostring(node, pretty_print=True, with_tail=False)
+
+def _when_reselected(action):
+    # Only apply ``action`` if its path has to be matched again, as its
+    # anchors are all outside the fragment
+    def _action(template, **kwargs):
+        if not anchor_state(template).anchored(action.path):
+            action(template=template, **kwargs)
+    functools.update_wrapper(_action, action)
+    return _action
+
+def _each_target(action, contents, bounds=None):
+    # Like ``action``, but what goes in at each target is
+    # ``contents(occurrence)``, and when ``bounds`` is a list it goes
+    # between a pair of comments added to it
+    def _insert(template, **kwargs):
+        state = anchor_state(template)
+        for occurrence, target in enumerate(state.select(action.path)):
+            items = contents(occurrence)
+            if bounds is not None:
+                start, end = lxml.etree.Comment(''), lxml.etree.Comment('')
+                bounds.append((start, end))
+            if getattr(action, 'replaces', False):
+                if bounds is not None:
+                    target.addprevious(start)
+                added = wiseguy.html.replace_with([target], items[0])
+                state.removed_elements()
+                state.inserted(added)
+                if bounds is not None:
+                    (added[-1] if added else start).addnext(end)
+                continue
+            if bounds is not None:
+                if action.index is None:
+                    target.append(start)
+                else:
+                    target.insert(action.index, end)
+            for item in items:
+                state.inserted(
+                    wiseguy.html.add_to([target], item, index=action.index))
+            if bounds is not None:
+                if action.index is None:
+                    target.append(end)
+                else:
+                    target.insert(action.index, start)
+    _insert.path = action.path
+    _insert.inserts = True
+    if getattr(action, 'replaces', False):
+        _insert.replaces = True
+    else:
+        _insert.index = action.index
+    return _insert
+
+def _placeholder(action, number):
+    def _element(occurrence):
+        return [wiseguy.html.parser.makeelement(
+            'template', {'data-wiseguy-deferred': '%d.%d' % (number, occurrence)})]
+    return _each_target(action, _element)
+
+def _evaluate_deferred(number, action, context, results):
+    try:
+        value = action.content_func(**context)
+        if getattr(action, 'multiple', False):
+            value = list(value)
+    except Exception:
+        results.put((number, None, sys.exc_info()))
+    else:
+        results.put((number, value, None))
+
+def _deferred_items(action, value):
+    if getattr(action, 'multiple', False):
+        return list(value)
+    return [value]
+
+def _deferred_html(content):
+    if isinstance(content, basestring):
+        return cgi.escape(content).encode('ascii', 'xmlcharrefreplace')
+    return lxml.html.tostring(content)
+
+def _touches(items, transforms):
+    # Could any of ``transforms`` select a node of the content ``items``?
+    elements = [item for item in items if not isinstance(item, basestring)]
+    if not elements:
+        return False
+    for transform in transforms:
+        path = getattr(transform.action, 'path', None)
+        if path == '':
+            continue
+        selector = _simple_selector(path)
+        if selector is None:
+            return True
+        for element in elements:
+            for el in element.iter(lxml.etree.Element):
+                if selector.subject_matches(el):
+                    return True
+    return False
+
+def _between(start, end):
+    if start.getparent() is None or start.getparent() is not end.getparent():
+        return ""
+    html = [_deferred_html(start.tail or "")]
+    for node in start.itersiblings():
+        if node is end:
+            break
+        html.append(lxml.html.tostring(node))
+    return "".join(html)
+
+def _deferred_fragments(shell, positions, number, actions, values, kwargs):
+    # The fragments for deferred transform ``number``, with what the
+    # transforms after it do to its content, or None until the values
+    # of the deferred ones among them are known too.  Most content
+    # isn't touched by them, and one fragment serves everywhere it went.
+    action = actions[number]
+    items = _deferred_items(action, values[number])
+    later = [transform for transform in shell.transforms[positions[number] + 1:]
+             if all(key in kwargs for key in transform.keys)]
+    if not _touches(items, later):
+        html = "".join(_deferred_html(item) for item in items)
+        return _deferred_fragment(str(number), html)
+    if any(other not in values for other in actions if other > number):
+        return None
+    transforms = list(shell.transforms)
+    def inline(other, action):
+        transform = transforms[positions[other]]
+        transforms[positions[other]] = Transform(
+            transform.keys, action, transform.context)
+    bounds = []
+    inline(number, _each_target(action, lambda occurrence: items, bounds))
+    for other in actions:
+        if other > number:
+            value = _deferred_items(actions[other], values[other])
+            inline(other, _each_target(
+                actions[other], lambda occurrence, value=value: value))
+    template = TemplateMeta(
+        shell.__name__,
+        (Template,),
+        dict(element=shell.element, transforms=transforms))
+    template.render_lxml(kwargs)
+    return "".join(
+        _deferred_fragment('%d.%d' % (number, occurrence), _between(start, end))
+        for occurrence, (start, end) in enumerate(bounds))
+
+def _deferred_fragment(name, html):
+    return '<template id="wiseguy-deferred-%s">%s</template><script>%s</script>\n' % (
+        name, html, _SWAP_SCRIPT % name)
+
+
 class SubTemplateMeta(TemplateMeta):
     def __init__(self, cls_name, bases, cls_dict):
         self.keys = [k for k in cls_dict if not k.startswith("_")]
@@ -94,15 +1169,118 @@ class SubTemplateMeta(TemplateMeta):
             if hasattr(value, 'transforms'):
                 self.transforms.extend(value.transforms)
 
+    def _value(self, key, context):
+        value = getattr(self, key)
+        if callable(value):
+            value = value(context)
+        return value
+
     def _iter_items(self, context):
         for key in self.keys:
-            value = getattr(self, key)
-            if callable(value):
-                value = value(context)
-            yield key, value
+            yield key, self._value(key, context)
 
     def __call__(self, context):
-        return dict(self._iter_items(context))
+        return LazyContext(
+            self.keys,
+            functools.partial(self._value, context=context))
+
+    def prefetch(self, context, keys=None, pool=None, deadline=None):
+        """Like calling the sub template, but start evaluating the values
+        for ``keys`` (all of them by default) concurrently on ``pool``.
+        Looking up one of them waits for it, for up to ``deadline``
+        seconds from now in total, then raises ``DeadlineExceeded``."""
+        if pool is None:
+            pool = value_pool()
+        if keys is None:
+            keys = self.keys
+        return ConcurrentContext(
+            self.keys,
+            functools.partial(self._value, context=context),
+            pool,
+            keys,
+            deadline)
+
+
+class LazyContext(collections.Mapping):
+    """A mapping that only evaluates a value the first time it is looked
+    up, and keeps it for later lookups.  Transforms only look up the
+    keys they wait on, so values nothing uses are never evaluated."""
+
+    def __init__(self, keys, evaluate):
+        self._keys = list(keys)
+        self._key_set = frozenset(self._keys)
+        self._evaluate = evaluate
+        self._values = dict()
+
+    def __repr__(self):
+        return "<LazyContext %s evaluated of %s>" % (sorted(self._values), self._keys)
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            if not key in self._key_set:
+                raise
+        value = self._values[key] = self._evaluate(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self._key_set
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def evaluated(self):
+        "The keys whose values have been evaluated so far"
+        return set(self._values)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ConcurrentContext(LazyContext):
+    "A LazyContext with some values already being evaluated on a pool"
+
+    def __init__(self, keys, evaluate, pool, prefetch, deadline=None):
+        super(ConcurrentContext, self).__init__(keys, evaluate)
+        if deadline is None:
+            self._deadline = None
+        else:
+            self._deadline = timeit.default_timer() + deadline
+        self._pending = dict(
+            (key, pool.apply_async(evaluate, (key,)))
+            for key in prefetch if key in self._key_set)
+
+    def __getitem__(self, key):
+        result = self._pending.get(key)
+        if result is None:
+            return super(ConcurrentContext, self).__getitem__(key)
+        if self._deadline is None:
+            timeout = None
+        else:
+            timeout = max(0, self._deadline - timeit.default_timer())
+        try:
+            value = result.get(timeout)
+        except multiprocessing.TimeoutError:
+            raise DeadlineExceeded(key)
+        del self._pending[key]
+        self._values[key] = value
+        return value
+
+_value_pool = None
+_value_pool_lock = threading.Lock()
+
+def value_pool(workers=8):
+    "The thread pool that sub template values are prefetched on by default"
+    global _value_pool
+    with _value_pool_lock:
+        if _value_pool is None:
+            _value_pool = multiprocessing.pool.ThreadPool(workers)
+    return _value_pool
 
 
 class SubTemplate(object):
@@ -112,6 +1290,7 @@ class SubTemplate(object):
 def bound_template(adder_func):
     class BoundTemplateMeta(TemplateMeta):
         def __init__(cls, cls_name, bases, cls_dict):
+            super(BoundTemplateMeta, cls).__init__(cls_name, bases, cls_dict)
             adder_func(cls)
 
     class BoundTemplate(Template):
@@ -128,48 +1307,153 @@ def register(collection):
 
 # Utils
 
-def extends(template):
+def flatten(template, *wrapped_templates):
+    """Resolve a chain of templates, outermost first, into a single new
+    template, eg ``flatten(base, section, page)``."""
+    new_template = template.copy()
+    new_template.extend(*wrapped_templates)
+    return new_template
+
+def overlay(template, *transforms):
+    """A variant of ``template`` that also applies ``transforms``, eg one
+    client's customisations of a shared layout.  It shares the element
+    of ``template`` rather than copying it, so must never be changed in
+    place, and shares its anchors and serialisation plan where the
+    transforms only reach regions the plan already has.  What it adds
+    is just the transforms and the anchors of any new paths."""
+    transforms = template.transforms + tuple(transforms)
+    base = template.pristine_anchors()
+    anchors = None
+    if base is not None:
+        anchors = Anchors(
+            template.element,
+            [path for path in _transform_paths(transforms) if not path in base.selectors])
+        anchors.selectors.update(base.selectors)
+        anchors.positions.update(base.positions)
+        plan = template.serialization_plan()
+        if (plan is not None) and (anchors._regions(transforms) == plan.regions):
+            anchors._plan = plan.share(anchors.positions, anchors._streams(transforms))
+    return TemplateMeta(
+        template.__name__,
+        (Template,),
+        dict(
+            element=template.element,
+            transforms=transforms,
+            anchors=anchors,
+            baked_transforms=template.baked_transforms))
+
+def extends(template, *wrapped_templates):
+    "Flatten the decorated template onto ``template`` and any ``wrapped_templates``"
     def _decorator(wrapped_template):
-        new_template = template.copy()
-        new_template.extend(
-            wrapped_template)
-        return new_template
+        return flatten(
+            template,
+            *(wrapped_templates + (wrapped_template,)))
     return _decorator
 
-def set_attr(path, attr, content_func):
+def select(template, path):
+    "The elements of ``template`` matching ``path``, using its anchors"
+    return anchor_state(template).select(path)
+
+_MISSING = object()
+
+def memoized(content_func, max_entries=128, materialise=False):
+    """Wrap ``content_func`` so that each distinct set of keyword
+    arguments is only computed once, keeping the last ``max_entries``
+    results.  ``materialise`` turns iterable results into lists, so
+    they can be used more than once."""
+    cache = wiseguy.caching.LRUCache(max_entries=max_entries)
+    def _memoized(**kwargs):
+        try:
+            key = _freeze(kwargs)
+        except TypeError:
+            return content_func(**kwargs)
+        result = cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = content_func(**kwargs)
+            if materialise:
+                result = list(result)
+            cache.set(key, result)
+        return result
+    _memoized.cache = cache
+    return _memoized
+
+def deferred(action):
+    """Mark an ``add``, ``add_multiple`` or ``replace`` action as deferred,
+    so that ``render_deferred`` streams the page without waiting for its
+    content.  Other renders apply it as usual."""
+    if not (getattr(action, 'replaces', False) or hasattr(action, 'index')):
+        raise ValueError("Only add and replace actions can be deferred")
+    action.deferred = True
+    return action
+
+def _memoize(content_func, memoize, materialise=False):
+    # The helpers copy elements when adding them, so a cached element
+    # can safely be handed out again
+    if not memoize:
+        return content_func
+    if memoize is True:
+        return memoized(content_func, materialise=materialise)
+    return memoized(content_func, max_entries=memoize, materialise=materialise)
+
+def set_attr(path, attr, content_func, memoize=None):
+    content_func = _memoize(content_func, memoize)
     def _set_attr(template, **kwargs):
-        template.element.set_attr(
-            path,
-            attr,
-            content_func(**kwargs))
+        value = content_func(**kwargs)
+        state = anchor_state(template)
+        for el in state.select(path):
+            el.attrib[attr] = value
+        state.changed_attribute(attr)
+    _set_attr.path = path
+    _set_attr.attribute = attr.lower()
+    _set_attr.content_func = content_func
     return _set_attr
 
-def set_text(path, content_func):
+def set_text(path, content_func, memoize=None):
+    content_func = _memoize(content_func, memoize)
     def _set_text(template, **kwargs):
-        for el in template.element.cssselect(path):
+        for el in select(template, path):
             el.text = content_func(**kwargs)
+    _set_text.path = path
+    _set_text.content_func = content_func
     return _set_text
 
-def replace(path, content_func):
+def replace(path, content_func, memoize=None):
+    content_func = _memoize(content_func, memoize)
     def _replace(template, **kwargs):
-        template.element.replace(
-            path,
-            content_func(**kwargs))
+        content = content_func(**kwargs)
+        state = anchor_state(template)
+        added = wiseguy.html.replace_with(state.select(path), content)
+        state.removed_elements()
+        state.inserted(added)
+    _replace.path = path
+    _replace.replaces = True
+    _replace.inserts = True
+    _replace.content_func = content_func
     return _replace
 
-def add(path, content_func, index=None):
+def add(path, content_func, index=None, memoize=None):
+    content_func = _memoize(content_func, memoize)
     def _add(template, **kwargs):
-        template.element.add(
-            path,
-            content_func(**kwargs),
-            index=index)
+        content = content_func(**kwargs)
+        state = anchor_state(template)
+        state.inserted(
+            wiseguy.html.add_to(state.select(path), content, index=index))
+    _add.path = path
+    _add.index = index
+    _add.inserts = True
+    _add.content_func = content_func
     return _add
 
-def add_multiple(path, content_func, index=None):
-    def _add(element, **kwargs):
+def add_multiple(path, content_func, index=None, memoize=None):
+    content_func = _memoize(content_func, memoize, materialise=True)
+    def _add(template, **kwargs):
+        state = anchor_state(template)
         for item in content_func(**kwargs):
-            element.add(
-                path,
-                item,
-                index=index)
+            state.inserted(
+                wiseguy.html.add_to(state.select(path), item, index=index))
+    _add.path = path
+    _add.index = index
+    _add.inserts = True
+    _add.multiple = True
+    _add.content_func = content_func
     return _add
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import collections, contextlib, copy, threading
+
+_local = threading.local()
+_stats = None
+
+
+def _label(path, keys):
+    if path:
+        return path
+    return ",".join(keys)
+
+
+class Trace(object):
+    """The transforms applied while it is active, with the keys they
+    consumed, how many nodes their path matched and how long they took.
+    Only the last ``max_entries`` are kept."""
+
+    def __init__(self, max_entries=1000):
+        self.entries = collections.deque(maxlen=max_entries)
+        self.recorded = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def record(self, template_name, keys, path, matches, seconds):
+        self.recorded = self.recorded + 1
+        self.entries.append(dict(
+            template=template_name,
+            keys=keys,
+            path=path,
+            matches=matches,
+            seconds=seconds))
+
+    @property
+    def dropped(self):
+        return self.recorded - len(self.entries)
+
+
+class Stats(object):
+    """Counters aggregated per template, and per transform within each
+    template.  Memory is bounded by the number of templates and
+    transforms, not by the number of renders."""
+
+    def __init__(self):
+        self.templates = dict()
+        self.lock = threading.Lock()
+
+    def record(self, template_name, keys, path, matches, seconds):
+        label = _label(path, keys)
+        with self.lock:
+            template = self.templates.get(template_name)
+            if template is None:
+                template = self.templates[template_name] = dict(
+                    transforms=0, matches=0, seconds=0.0, by_transform=dict())
+            transform = template['by_transform'].get(label)
+            if transform is None:
+                transform = template['by_transform'][label] = dict(
+                    count=0, matches=0, seconds=0.0)
+            for counters in (template, transform):
+                counters['matches'] = counters['matches'] + (matches or 0)
+                counters['seconds'] = counters['seconds'] + seconds
+            template['transforms'] = template['transforms'] + 1
+            transform['count'] = transform['count'] + 1
+
+    def export(self):
+        with self.lock:
+            return copy.deepcopy(self.templates)
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+
+
+@contextlib.contextmanager
+def tracing(trace=None):
+    "Record the transforms applied in this thread into ``trace``"
+    if trace is None:
+        trace = Trace()
+    stack = _local.__dict__.setdefault('traces', [])
+    stack.append(trace)
+    try:
+        yield trace
+    finally:
+        stack.pop()
+
+def enable_stats(stats=None):
+    "Aggregate counters for transforms applied in every thread"
+    global _stats
+    if stats is None:
+        stats = Stats()
+    _stats = stats
+    return stats
+
+def disable_stats():
+    global _stats
+    _stats = None
+
+def recorders():
+    "The active traces and stats, or an empty tuple when there are none"
+    stack = _local.__dict__.get('traces')
+    if stack:
+        if _stats is None:
+            return (stack[-1],)
+        return (stack[-1], _stats)
+    if _stats is None:
+        return ()
+    return (_stats,)
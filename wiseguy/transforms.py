@@ -6,7 +6,7 @@ import cssselect
 css = cssselect.HTMLTranslator().css_to_xpath
 
 from wiseguy import html_tags as ht
-from wiseguy.template import Transform
+from wiseguy.template import Transform, add
 
 
 def stylesheet(href):
@@ -22,16 +22,12 @@ def script(href):
 def add_stylesheet(href):
     return Transform(
         [],
-        lambda template: template.element.add(
-            "head",
-            stylesheet(href)))
+        add("head", lambda: stylesheet(href)))
 
 def add_script(href):
     return Transform(
         [],
-        lambda template: template.element.add(
-            "head",
-            script(href)))
+        add("head", lambda: script(href)))
 
 _url_fixable_tags = set([
     ("link", "href"),
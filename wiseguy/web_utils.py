@@ -12,6 +12,7 @@ import path
 import jade
 
 from wiseguy import form_fields, utils
+import wiseguy.template
 
 
 class TemplateNotFound(Exception):
@@ -99,19 +100,31 @@ class LxmlEnv(object):
     def update_globals(self, context):
         self.globals.update(context)
 
-    def render(self, template_name, context):
+    def _template(self, template_name, context):
         local_context = dict(self.globals)
         local_context.update(context)
         try:
             template = getattr(self.env, template_name)
         except AttributeError:
             raise TemplateNotFound()
+        return template, local_context
+
+    def render(self, template_name, context):
+        template, local_context = self._template(template_name, context)
         element = template(local_context)
         html = element.to_string()
         return html
 
+    def render_iter(self, template_name, context):
+        """The rendered template as chunks of html, for streaming, with
+        any deferred regions sent last"""
+        template, local_context = self._template(template_name, context)
+        if hasattr(template, 'render_deferred'):
+            return template.render_deferred(local_context)
+        return iter([template(local_context).to_string()])
+
     def get_response(self, template_name, context, mimetype="text/html"):
-        body = self.render(template_name, context)
+        body = self.render_iter(template_name, context)
         res = wz.Response(body, mimetype=mimetype)
         return res
 
@@ -217,6 +230,29 @@ def make_client_env(var_dir, client, extra_globals=None):
         env.globals.update(extra_globals)
     return env
 
+class OverlayEnv(object):
+    """The templates of ``env``, each overlaid with the transforms that
+    ``overrides`` has for it under the same name, if any"""
+    def __init__(self, env, overrides):
+        self.env = env
+        self.overrides = overrides
+        self.overlays = dict()
+
+    def __getattr__(self, template_name):
+        template = getattr(self.env, template_name)
+        transforms = getattr(self.overrides, template_name, None)
+        if transforms is None:
+            return template
+        overlay = self.overlays.get(template_name)
+        if overlay is None:
+            overlay = wiseguy.template.overlay(template, *transforms)
+            self.overlays[template_name] = overlay
+        return overlay
+
+def make_client_lxml_env(env, overrides, global_context=None):
+    "Like ``make_client_env``, but for the templates in ``env``"
+    return LxmlEnv(OverlayEnv(env, overrides), global_context)
+
 
 class UrlMap(wz.routing.Map):
     def __init__(self, rules=None, views=None, *args, **kwargs):